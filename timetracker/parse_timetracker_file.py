@@ -43,7 +43,8 @@ Note: A line is just that: a line.
 This is then further processed to create matching start-stop timespans:
     timespans_by_label = {<label>:
         [
-          {starttime: <start datetime>, timespan: <stop-time minus start-time), label: (label), comment: None}
+          {start: <start datetime>, stop: <stop datetime>, timespan: <stop-time minus start-time),
+           label: (label), tags: (tuple of tags of the start line), comment: (comment of the start line or None)}
         ]}
 
 
@@ -61,9 +62,19 @@ Other timeline tools:
 import sys
 import os
 import re
-import yaml
+import mmap
 import glob
 import argparse
+import contextlib
+import heapq
+import json
+import bisect
+import itertools
+import hashlib
+import io
+import time
+from array import array
+from operator import itemgetter, le
 from collections import defaultdict
 import logging
 logger = logging.getLogger(__name__)
@@ -76,36 +87,468 @@ line_regex_str = r"(?P<datetime>[\d\.-]+[:\s][\d\.:]+)\s+(?P<action>\w+)\s+(?P<l
 line_regex_str = r"^(?P<datetime>[\d\.-]+[:\s][\d\.:]+)\s+(?P<action>\w+)\s+(?P<label>[^#,]+)"\
                  r"(?P<tags>(\s*#\w+)*)(,\s+(?P<comment>.+))?$"
 line_pat = re.compile(line_regex_str)
+# Bytes version of line_regex_str, used by parse_file_bulk to parse all lines of a whole-file buffer with findall.
+# Every line is matched, either by the line pattern or (if that fails) by the [^\n]* alternative, which leaves
+# all groups empty. The position of each match in the findall result is thus also its line number.
+# Whitespace is restricted to [^\S\n], so the line pattern never spans several lines, and leading/trailing
+# whitespace is matched outside the groups, since parse_file strips each line before matching.
+# Note: Tags may contain any non-ascii characters, since bytes \w only matches ascii word characters.
+line_bytes_regex = rb"^(?:[^\S\n]*(?P<datetime>[\d\.-]+[:\t\x0b\x0c\r ][\d\.:]+)[^\S\n]+(?P<action>\w+)"\
+                   rb"[^\S\n]+(?P<label>[^#,\n]+)(?P<tags>(?:[^\S\n]*#(?:\w|[\x80-\xff])+)*)"\
+                   rb"(?:,[^\S\n]+(?P<comment>[^\n]*\S))?[^\S\n]*|[^\n]*)(?:\n|\Z)"
+line_bytes_pat = re.compile(line_bytes_regex, re.MULTILINE)
+# Bytes of lines that parse_file_bulk parses as str (non-ascii, and \x1c-\x1f, which are whitespace in str),
+# and bare carriage returns, which are line breaks when reading in text mode (as parse_file does):
+str_whitespace_pat = re.compile(rb"[\x1c-\x1f\x80-\xff]")
+bare_cr_pat = re.compile(rb"\r(?!\n)")
 datestrptime = "%Y-%m-%d %H.%M" #"yyyy-mm-dd HH.MM"
 
+# Cache with {"yyyy-mm-dd": (year, month, day)}, used by parse_timestamp:
+_date_cache = {}
 
-def parse_files(filenames):
+
+def parse_timestamp(datestr):
+    """
+    Parse datestr in the datestrptime format, "yyyy-mm-dd HH.MM", to a datetime object.
+
+    This is equivalent to datetime.strptime(datestr, datestrptime), but much faster:
+    For the fixed-width format, the integer fields are sliced out directly and the
+    parsed date part is memoized (since many lines share the same date).
+    Other strings are passed on to strptime, e.g. if the fields are not zero-padded.
+    Raises ValueError if datestr cannot be parsed.
+    """
+    if len(datestr) == 16 and datestr[10] == " " and datestr[13] == ".":
+        try:
+            year, month, day = _date_cache[datestr[:10]]
+        except KeyError:
+            datepart = datestr[:10]
+            if datepart[4] == "-" and datepart[7] == "-" \
+            and datepart[:4].isdigit() and datepart[5:7].isdigit() and datepart[8:].isdigit():
+                year, month, day = int(datepart[:4]), int(datepart[5:7]), int(datepart[8:])
+                try:
+                    datetime(year, month, day)  # Only cache valid dates
+                    _date_cache[datepart] = (year, month, day)
+                except ValueError:
+                    year = None
+            else:
+                year = None
+        # int() also accepts e.g. "-0", "+1" and " 1", which strptime rejects:
+        if year is not None and datestr[11:13].isdigit() and datestr[14:].isdigit():
+            try:
+                return datetime(year, month, day, int(datestr[11:13]), int(datestr[14:]))
+            except ValueError:
+                pass
+    return datetime.strptime(datestr, datestrptime)
+
+
+# Sort key for line dicts. See get_lines_by_label for considerations regarding sorting.
+line_sort_key = itemgetter("datetime", "filename", "lineno", "label", "action")
+
+
+def parse_files(filenames, bulk=False, workers=None, cache_dir=None, rebuild_cache=False):
     """
     All filenames are parsed into the same data structure, a list of dicts with items:
-        {datetime, action, label, lineno}
+        {datetime, action, label, tags, comment, filename, lineno}
+    If bulk is True, files are parsed with parse_file_bulk instead of line-by-line (the result is the same).
+    If cache_dir is given, files are parsed with parse_file_cached using that cache directory
+    (which always uses parse_file_bulk, so bulk is ignored).
+    If rebuild_cache is True, existing cache files are ignored.
+
+    If workers is more than 1, the returned lines are sorted by line_sort_key (so get_lines_by_label can be
+    called with presorted=True), and the files are parsed in a pool of up to that many processes (no more
+    than the number of files and CPUs; with only one file or CPU, the files are parsed serially).
+    Each worker returns its file's lines sorted and in compact EventColumns form, which is much cheaper
+    to send back than line dicts; the sorted runs are then merged with heapq.merge (see _merge_column_runs).
+    Otherwise, the lines are returned in the order they are parsed.
     """
+    if workers and workers > 1:
+        nworkers = min(workers, len(filenames), os.cpu_count() or 1)
+        if nworkers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(nworkers) as executor:
+                return _merge_column_runs(executor.map(_parse_file_columns, filenames, [bulk]*len(filenames),
+                                                       [cache_dir]*len(filenames), [rebuild_cache]*len(filenames)))
+        runs = [_parse_file_sorted(filename, bulk, cache_dir, rebuild_cache) for filename in filenames]
+        return list(heapq.merge(*runs, key=line_sort_key))
     lines = []
     for filename in filenames:
-        with open(filename) as filep:
-            for lineno, line in enumerate(filep):
-                match = line_pat.match(line.strip())
-                if not match:
-                    logger.info("%s:%s did not match line regex.", filename, lineno)
-                    continue
-                linedict = match.groupdict()
-                linedict["label"] = linedict["label"].title()
-                linedict["action"] = linedict["action"].lower()
-                linedict["datetime"] = datetime.strptime(linedict["datetime"], datestrptime)
-                linedict["filename"] = filename
-                linedict["lineno"] = lineno
-                lines.append(linedict)
+        lines.extend(_parse_file(filename, bulk, cache_dir, rebuild_cache))
     return lines
 
 
-def get_lines_by_label(lines, auto_stop_on_start=True, discart_redundant_stops=False):
+def _parse_file(filename, bulk=False, cache_dir=None, rebuild_cache=False):
+    """ Parse a single file, using the parser selected by the parse_files arguments. """
+    if cache_dir:
+        return parse_file_cached(filename, cache_dir, rebuild=rebuild_cache)
+    return parse_file_bulk(filename) if bulk else parse_file(filename)
+
+
+def _parse_file_sorted(filename, bulk=False, cache_dir=None, rebuild_cache=False):
+    """ Parse a single file and return its lines sorted by line_sort_key. Used as worker by parse_files. """
+    lines = _parse_file(filename, bulk, cache_dir, rebuild_cache)
+    # Within a file, lines are already ordered by lineno, so only need to check that datetimes are sorted:
+    datetimes = [line["datetime"] for line in lines]
+    if not all(map(le, datetimes, datetimes[1:])):
+        lines.sort(key=line_sort_key)
+    return lines
+
+
+def _parse_file_columns(filename, bulk=False, cache_dir=None, rebuild_cache=False):
+    """ Parse a single file and return its lines, sorted by line_sort_key, as EventColumns. Worker for parse_files. """
+    return lines_to_columns(_parse_file_sorted(filename, bulk, cache_dir, rebuild_cache))
+
+
+def _merge_column_runs(runs):
+    """
+    Merge runs of EventColumns, each sorted by line_sort_key and from one file, into one sorted list of line dicts.
+    Each run is converted to line dicts as soon as it is available from the runs iterable (e.g. while the workers
+    still parse the other files). The runs are merged on compact (minutes, filename, lineno) keys, which are unique
+    within a file, so the line dicts themselves are never compared. If a file is given twice, its (equal) lines are
+    kept in the order of the runs.
+    """
+    keys = []
+    for i, columns in enumerate(runs):
+        filenames = map((columns.strings + [None]).__getitem__, columns.filename)
+        keys.append(zip(columns.minutes, filenames, columns.lineno, itertools.repeat(i), columns_to_lines(columns)))
+    return [key[-1] for key in heapq.merge(*keys)]
+
+
+def parse_file(filename):
+    """ Parse a single file line-by-line, returning a list of line dicts (see parse_files). """
+    with open(filename) as filep:
+        return _parse_lines(filep, filename)
+
+
+def _parse_lines(lines, filename, lineno=0):
+    """ Parse lines (str, with or without newline) line-by-line, the first being lineno, as parse_file does. """
+    linedicts = []
+    for lineno, line in enumerate(lines, lineno):
+        match = line_pat.match(line.strip())
+        if not match:
+            logger.info("%s:%s did not match line regex.", filename, lineno)
+            continue
+        linedict = match.groupdict()
+        # The label is followed by any whitespace before the tags or comment:
+        linedict["label"] = linedict["label"].rstrip().title()
+        if not linedict["label"]:
+            logger.info("%s:%s did not match line regex.", filename, lineno)
+            continue
+        linedict["action"] = linedict["action"].lower()
+        try:
+            linedict["datetime"] = parse_timestamp(linedict["datetime"])
+        except ValueError:
+            logger.warning("%s:%s has malformed timestamp %r (expected format %r) - skipping line.",
+                           filename, lineno, linedict["datetime"], datestrptime)
+            continue
+        linedict["filename"] = filename
+        linedict["lineno"] = lineno
+        linedicts.append(linedict)
+    return linedicts
+
+
+def parse_file_bulk(filename, offset=0, lineno=0, end=None):
+    """
+    Parse a single file by memory-mapping it and matching line_bytes_pat over the whole buffer.
+    Returns the same list of line dicts as parse_file, but avoids reading, stripping and matching
+    each line separately, and each distinct label, action and tags string is decoded only once
+    (and shared between lines).
+    The bytes pattern only knows ascii whitespace and word characters, so lines with non-ascii bytes or
+    the ascii separator characters \x1c-\x1f (which are whitespace in str) are decoded and parsed as
+    in parse_file. If the file has a bare carriage return (a line break in parse_file, which reads the
+    file in text mode), the whole file is parsed as in parse_file.
+
+    Args:
+        filename: The file to parse (assumed to be utf-8 encoded).
+        offset: Byte offset to start parsing from. Must be 0 or just after a newline.
+        lineno: The line number of the line starting at offset.
+        end: Byte offset to stop parsing at (default: end of file).
+    """
+    lines = []
+    with open(filename, "rb") as filep:
+        if end is None:
+            end = os.fstat(filep.fileno()).st_size
+        if end <= offset:
+            return lines    # Note: mmap cannot map empty files.
+        with mmap.mmap(filep.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if bare_cr_pat.search(buf, offset, end):
+                return _parse_lines(io.StringIO(buf[offset:end].decode(), newline=None), filename, lineno)
+            matches = line_bytes_pat.findall(buf, offset, end)
+            if buf[end-1:end] == b"\n":
+                matches.pop()   # Empty match after the final newline.
+            # {line number: line} for lines that must be parsed as str:
+            text_lines, text_lineno, pos = {}, lineno, offset
+            match = str_whitespace_pat.search(buf, offset, end)
+            while match:
+                start = buf.rfind(b"\n", pos, match.start()) + 1 or pos
+                stop = buf.find(b"\n", match.start(), end)
+                stop = end if stop == -1 else stop
+                text_lineno += buf[pos:start].count(b"\n")
+                text_lines[text_lineno] = buf[start:stop].decode()
+                pos = start
+                match = str_whitespace_pat.search(buf, stop, end)
+    labels, actions, tagstrs = {}, {}, {}
+    dateparts = {}  # {b"yyyy-mm-dd ": (year, month, day)}
+    log_unmatched = logger.isEnabledFor(logging.INFO)
+    for lineno, (datestr, action, label, tags, comment) in enumerate(matches, lineno):
+        if text_lines and lineno in text_lines:
+            lines.extend(_parse_lines([text_lines[lineno]], filename, lineno))
+            continue
+        try:
+            label = labels[label]
+        except KeyError:
+            # The label includes any whitespace before the tags/comment or at the end of the line.
+            # An empty label (unmatched line) or one consisting of only whitespace does not match:
+            labelstr = label.decode().rstrip()
+            labels[label] = labelstr = labelstr.title() if labelstr else None
+            label = labelstr
+        if label is None:
+            if log_unmatched:
+                logger.info("%s:%s did not match line regex.", filename, lineno)
+            continue
+        # Same as parse_timestamp, but without decoding datestr:
+        datepart = dateparts.get(datestr[:11]) \
+            if datestr[13:14] == b"." and datestr[11:13].isdigit() and datestr[14:].isdigit() else None
+        try:
+            if datepart is None:
+                timestamp = parse_timestamp(datestr.decode())
+                if len(datestr) == 16 and datestr[10:11] == b" " and datestr[13:14] == b".":
+                    dateparts[datestr[:11]] = (timestamp.year, timestamp.month, timestamp.day)
+            else:
+                timestamp = datetime(*datepart, int(datestr[11:13]), int(datestr[14:]))
+        except ValueError:
+            logger.warning("%s:%s has malformed timestamp %r (expected format %r) - skipping line.",
+                           filename, lineno, datestr.decode(), datestrptime)
+            continue
+        try:
+            action = actions[action]
+        except KeyError:
+            actions[action] = action = action.decode().lower()
+        try:
+            tags = tagstrs[tags]
+        except KeyError:
+            tagstrs[tags] = tags = tags.decode()
+        lines.append({"datetime": timestamp, "action": action, "label": label, "tags": tags,
+                      "comment": comment.decode() if comment else None,
+                      "filename": filename, "lineno": lineno})
+    return lines
+
+
+EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+
+def datetime_to_epoch_minutes(dt):
+    """ Return the number of whole minutes from 1970-01-01 00:00 to the (naive) datetime dt. """
+    return (dt.toordinal() - EPOCH_ORDINAL)*1440 + dt.hour*60 + dt.minute
+
+
+def epoch_minutes_to_datetime(minutes, _dates={}):     # pylint: disable=W0102
+    """ Return datetime for minutes since 1970-01-01 00:00 (the inverse of datetime_to_epoch_minutes). """
+    days, minutes = divmod(minutes, 1440)
+    try:
+        year, month, day = _dates[days]
+    except KeyError:
+        date = datetime.fromordinal(days + EPOCH_ORDINAL)
+        year, month, day = _dates[days] = (date.year, date.month, date.day)
+    return datetime(year, month, day, minutes // 60, minutes % 60)
+
+
+def default_cache_dir():
+    """ Return the default directory for parse_file_cached cache files. """
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                        "timetracker")
+
+
+# Cache file format used by parse_file_cached: A magic line, a json header line with file info and the
+# string table for actions/labels/tags/comments, followed by the raw bytes of the event arrays.
+# Each event array has one item per parsed line, in the order given by cache_arrays (typecode, name):
+cache_magic = b"TimeTrackerCache 3\n"
+cache_arrays = (("q", "minutes"), ("q", "lineno"), ("i", "action"), ("i", "label"), ("i", "tags"), ("i", "comment"))
+
+
+def parse_file_cached(filename, cache_dir, rebuild=False):
+    """
+    Parse a single file, using (and updating) a cache file with the parsed lines in cache_dir.
+    Returns the same list of line dicts as parse_file.
+
+    The cache is valid if the cached part of the file (the prefix) is unchanged, as checked by a hash of
+    the prefix. This is checked every time, also if the size and modification time of the file are
+    unchanged, since a file can be edited in place without changing them (hashing costs a few ms per MB).
+    If the file has grown, only the new lines at the end of the file are parsed (with parse_file_bulk,
+    which gives the same result as parse_file) and added to the cache. If the file has been modified in
+    any other way, or rebuild is True, the whole file is parsed and the cache file is re-created.
+    Only complete lines are cached; a final line without newline is parsed every time.
+    Note: Only parsing is cached. The line dicts are re-created from the cache (about 2-3 times faster
+    than parse_file_bulk), and all lines are still paired and filtered by the rest of the pipeline.
+    """
+    path = os.path.abspath(filename)
+    cachefn = os.path.join(cache_dir, hashlib.sha1(path.encode()).hexdigest() + ".cache")
+    stat = os.stat(filename)
+    cache = None if rebuild else _read_cache_file(cachefn)
+    with open(filename, "rb") as filep:
+        # Note: mmap cannot map empty files.
+        with mmap.mmap(filep.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size \
+        else contextlib.nullcontext(b"") as buf:
+            if cache and cache["path"] == path and cache["offset"] <= stat.st_size \
+            and hashlib.sha1(buf[:cache["offset"]]).hexdigest() == cache["prefix_sha1"]:
+                if (cache["size"], cache["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+                    logger.debug("Using cached lines for %s.", filename)
+                else:
+                    logger.debug("File %s has changed after the cached part, parsing new lines.", filename)
+            elif cache:
+                logger.debug("Cache file %s is for a different file, or the cached part of %s has changed, "
+                             "re-parsing file.", cachefn, filename)
+                cache = None
+            if cache is None:
+                cache = {"path": path, "offset": 0, "next_lineno": 0, "strings": [],
+                         "prefix_sha1": hashlib.sha1(b"").hexdigest()}
+                cache.update((name, array(typecode)) for typecode, name in cache_arrays)
+            end = buf.rfind(b"\n") + 1    # End of last complete line.
+            if end > cache["offset"]:
+                _add_cache_lines(cache, parse_file_bulk(filename, cache["offset"], cache["next_lineno"], end))
+                cache["next_lineno"] += _count_lines(buf[cache["offset"]:end])
+                cache["offset"] = end
+                cache["prefix_sha1"] = hashlib.sha1(buf[:end]).hexdigest()
+            if (cache.get("size"), cache.get("mtime_ns")) != (stat.st_size, stat.st_mtime_ns):
+                cache["size"], cache["mtime_ns"] = stat.st_size, stat.st_mtime_ns
+                _write_cache_file(cachefn, cache)
+    lines = _get_cache_lines(cache, filename)
+    if end < stat.st_size:
+        lines.extend(parse_file_bulk(filename, end, cache["next_lineno"], stat.st_size))
+    return lines
+
+
+def _count_lines(data):
+    """ Return the number of line breaks in data (bytes) when read in text mode, i.e. \n, \r\n or \r. """
+    return data.count(b"\n") + data.count(b"\r") - data.count(b"\r\n")
+
+
+def _add_cache_lines(cache, lines):
+    """ Add line dicts to the cache arrays. """
+    strings = cache["strings"]
+    string_ids = {string: i for i, string in enumerate(strings)}
+    def string_id(string):
+        """ Return the index of string in the cache's string table (None has index -1). """
+        if string is None:
+            return -1
+        try:
+            return string_ids[string]
+        except KeyError:
+            string_ids[string] = len(strings)
+            strings.append(string)
+            return string_ids[string]
+    cache["minutes"].extend(datetime_to_epoch_minutes(line["datetime"]) for line in lines)
+    cache["lineno"].extend(line["lineno"] for line in lines)
+    for key in ("action", "label", "tags", "comment"):
+        cache[key].extend(string_id(line[key]) for line in lines)
+
+
+def _get_cache_lines(cache, filename):
+    """ Return the cached lines as a list of line dicts. """
+    strings = cache["strings"] + [None]     # index -1 is None
+    return [{"datetime": epoch_minutes_to_datetime(minutes), "action": strings[action], "label": strings[label],
+             "tags": strings[tags], "comment": strings[comment], "filename": filename, "lineno": lineno}
+            for minutes, action, label, tags, comment, lineno
+            in zip(cache["minutes"], cache["action"], cache["label"], cache["tags"], cache["comment"],
+                   cache["lineno"])]
+
+
+def _read_cache_file(cachefn):
+    """ Read cache file written by _write_cache_file. Returns None if the file is missing or invalid. """
+    try:
+        with open(cachefn, "rb") as filep:
+            if filep.readline() != cache_magic:
+                raise ValueError("Not a cache file.")
+            cache = json.loads(filep.readline().decode())
+            for typecode, name in cache_arrays:
+                cache[name] = array(typecode)
+                cache[name].fromfile(filep, cache["nlines"])
+        return cache
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, EOFError, KeyError) as exc:
+        logger.warning("Could not read cache file %s (%s), the file will be re-parsed.", cachefn, exc)
+        return None
+
+
+def _write_cache_file(cachefn, cache):
+    """ Write cache to cachefn (via a temporary file, so a cache file is never partially written). """
+    array_names = [name for _, name in cache_arrays]
+    header = {key: value for key, value in cache.items() if key not in array_names}
+    header["nlines"] = len(cache["minutes"])
+    os.makedirs(os.path.dirname(cachefn), exist_ok=True)
+    tmpfn = "%s.%s.tmp" % (cachefn, os.getpid())
+    with open(tmpfn, "wb") as filep:
+        filep.write(cache_magic)
+        filep.write(json.dumps(header).encode() + b"\n")
+        for _, name in cache_arrays:
+            cache[name].tofile(filep)
+    os.replace(tmpfn, cachefn)
+
+
+def get_lines_by_label(lines, auto_stop_on_start=True, discart_redundant_stops=False, presorted=False):
     """
     lines is a list of dicts as returned by parse_files.
-    If auto_stop_on_start is True (default), then
+    If auto_stop_on_start is True (default), then starting an activity will
+    automatically stop all running activities (by adding a stop entry at the same time).
+    If discart_redundant_stops is True, stop entries for activities that are not running are discarted.
+    If presorted is True, lines must already be sorted by line_sort_key, e.g. as returned by
+    parse_files with workers > 1.
+    """
+    # First sort lines by datetime, in place:
+    # (this makes downstream processing much easier)
+    # Sorting is not actually trivial. We might have:
+    #     16.00 start activity1
+    #     16.00 stop activity1    # Stopped within less than 1 minute
+    # or
+    #     15.50 start activity2
+    #     16.00 stop activity2
+    #     16.00 start activity1   # A new activity started right after
+    #     16.00 stop activity1    # and is then stopped again
+    # In this case, sorting by lineno might be the best option...
+    # This might provide issues in the above case if sourced from multiple files,
+    # i.e. if you stop one activity in one file and start another in the same minute in another file.
+    if not presorted:
+        lines.sort(key=line_sort_key)
+    lines_by_label = defaultdict(list)
+    # Labels whose last entry is a start entry. Keeping track of these means that a start entry
+    # only has to close the activities that are actually running, not check every label:
+    running_labels = set()
+    debug = logger.isEnabledFor(logging.DEBUG)
+    for linedict in lines:
+        label = linedict["label"]
+        action = linedict["action"]
+        # Do not add stop entries if this activity has already been stopped:
+        if discart_redundant_stops and action == "stop" \
+        and (label not in lines_by_label or lines_by_label[label][-1]["action"] == "stop"):
+            # dont add stop entry if empty list or the last entry was stop:
+            if debug:
+                logger.debug("Not adding redundant stop entry: %s", linedict)
+            continue
+        # Stop running activities if auto_stop_on_start and action=start:
+        if auto_stop_on_start and action == "start":
+            for other_label in running_labels:
+                # The last entry is start, so add an entry that closes it:
+                stopdict = {"action": "stop", "label": other_label, "datetime": linedict["datetime"]}
+                if debug:
+                    logger.debug("Adding automatic stop entry: %s", stopdict)
+                lines_by_label[other_label].append(stopdict)
+            running_labels.clear()
+        linedict.pop("lineno")
+        linedict.pop("filename")
+        # Add entry:
+        lines_by_label[label].append(linedict)
+        if action == "start":
+            running_labels.add(label)
+        else:
+            running_labels.discard(label)
+
+    return lines_by_label
+
+
+def _get_lines_by_label_scan(lines, auto_stop_on_start=True, discart_redundant_stops=False):
+    """
+    Original get_lines_by_label (verbatim), which checks the last entry of every label for each start line.
+    Only kept as reference for benchmark_lines_by_label().
     """
     # First sort lines by datetime, in place:
     # (this makes downstream processing much easier)
@@ -151,10 +594,66 @@ def get_lines_by_label(lines, auto_stop_on_start=True, discart_redundant_stops=F
     return lines_by_label
 
 
-def find_timespans_by_label(lines_by_label):
+def find_timespans_by_label(lines_by_label, now=None):
     """
     Input dict with lines by labels,
     calculate "entries" by for each start-line, find the next stop line.
+
+    Each label's lines are walked once: start lines are queued as pending entries, and
+    a stop line closes all pending entries (so repeated starts without a stop share the
+    same stop). A second pass over the entries then sets "now" as stoptime for
+    open-ended entries and warns about entries overlapping the next start.
+    This is linear in the number of lines, where the original implementation
+    (kept as _find_timespans_by_label_quadratic) re-scanned the remaining lines for every start.
+
+    Args:
+        lines_by_label: dict with {label: [list of line dicts, sorted by datetime]}.
+        now: Stoptime used for entries without a stop line. Defaults to datetime.now().
+
+    Each entry gets the tags (as a tuple, see split_tags) and comment of its start line.
+    """
+    if now is None:
+        now = datetime.now()
+    timespans_by_label = defaultdict(list)
+    tagsets = {}    # {tags string: tuple of tags}
+    for label, lines in lines_by_label.items():
+        entries = []
+        n_stopped = 0   # entries[:n_stopped] have been assigned a stoptime
+        for line in lines:
+            action = line["action"]
+            if action == "start":
+                tags = line.get("tags")
+                try:
+                    tags = tagsets[tags]
+                except KeyError:
+                    tags = tagsets[tags] = split_tags(tags)
+                entries.append({"label": label, "start": line["datetime"], "tags": tags,
+                                "comment": line.get("comment")})
+            elif action == "stop":
+                for entry in entries[n_stopped:]:
+                    entry["stop"] = line["datetime"]
+                n_stopped = len(entries)
+        if not entries:
+            continue
+        for entry, next_entry in zip(entries, entries[1:] + [None]):
+            if "stop" not in entry:
+                logger.warning("Stoptime for entry %s @ %s WAS NOT FOUND. Setting stoptime to now.",
+                               entry["label"], entry["start"])
+                entry["stop"] = now
+            # Check for overlapping timespans. This shouldn't happen if using auto_stop_on_start=True
+            elif next_entry and entry["stop"] > next_entry["start"]:
+                logger.warning("Stoptime for entry %s @ %s is later than the next "\
+                               "start time for this label: %s > %s",
+                               entry["label"], entry["start"], entry["stop"], next_entry["start"])
+            entry["timespan"] = entry["stop"] - entry["start"]  # datetime - datetime -> timedelta
+        timespans_by_label[label] = entries
+    return timespans_by_label
+
+
+def _find_timespans_by_label_quadratic(lines_by_label):
+    """
+    Original implementation of find_timespans_by_label, which scans lines[i+1:] for every start line.
+    Only kept as reference for test_timespans_regression().
     """
     timespans_by_label = defaultdict(list)
     for label, lines in lines_by_label.items():
@@ -181,103 +680,1506 @@ def find_timespans_by_label(lines_by_label):
                 timespans_by_label[label].append(entry)
     return timespans_by_label
 
-def filter_timespans(timespans_by_label, args):
-    """ Filter timespans by criteria in args, e.g. start/end time. """
-    time_criteria = ("start_before", "start_after", "end_before", "end_after")
+def split_tags(tags):
+    """
+    Split a tags string, e.g. " #work #Fun", into a tuple of lower-case tags without '#', e.g. ("work", "fun").
+    Tags that are already split (a list or tuple) are just normalized. None gives an empty tuple.
+    """
+    if not tags:
+        return ()
+    if isinstance(tags, str):
+        tags = tags.split("#")
+    return tuple(dict.fromkeys(tag for tag in (tag.strip().lstrip("#").lower() for tag in tags) if tag))
+
+
+class TimespanColumns(object):
+    """
+    Compact, column-oriented storage of timespans, as an alternative to timespans_by_label dicts.
+    Each timespan is stored as one item in each of the arrays:
+        start, stop: array of int64 minutes since 1970-01-01 00:00 (see datetime_to_epoch_minutes).
+        label_id: array of int32 indices in the label table, labels.
+        tags_id: array of int32 indices in the table of tag tuples, tagsets (tagsets[0] is the empty tuple).
+        comment_id: array of int32 indices in the comment table, comments. Index -1 is None.
+    The arrays support the buffer protocol, so e.g. numpy.frombuffer can use them without copying.
+    Use timespans_to_columns and columns_to_timespans to convert from/to timespans_by_label.
+    """
+    __slots__ = ("labels", "tagsets", "comments", "start", "stop", "label_id", "tags_id", "comment_id")
+
+    def __init__(self):
+        self.labels = []
+        self.tagsets = [()]
+        self.comments = []
+        self.start = array("q")
+        self.stop = array("q")
+        self.label_id = array("i")
+        self.tags_id = array("i")
+        self.comment_id = array("i")
+
+    def __len__(self):
+        return len(self.start)
+
+    def nbytes(self):
+        """ Return the number of bytes used by the arrays. """
+        return sum(arr.itemsize*len(arr) for arr in
+                   (self.start, self.stop, self.label_id, self.tags_id, self.comment_id))
+
+
+class EventColumns(object):
+    """
+    Compact, column-oriented storage of parsed lines (events), as an alternative to the list of line dicts
+    returned by parse_files. Each line is stored as one item in each of the arrays:
+        minutes: array of int64 minutes since 1970-01-01 00:00 (see datetime_to_epoch_minutes).
+        lineno: array of int64 line numbers.
+        action, label, tags, comment, filename: array of int32 indices in the string table,
+            strings. Index -1 is None.
+    Use lines_to_columns and columns_to_lines to convert from/to line dicts.
+    """
+    __slots__ = ("strings", "minutes", "lineno", "action", "label", "tags", "comment", "filename")
+    string_keys = ("action", "label", "tags", "comment", "filename")
+
+    def __init__(self):
+        self.strings = []
+        self.minutes = array("q")
+        self.lineno = array("q")
+        for key in self.string_keys:
+            setattr(self, key, array("i"))
+
+    def __len__(self):
+        return len(self.minutes)
+
+    def nbytes(self):
+        """ Return the number of bytes used by the arrays. """
+        return sum(arr.itemsize*len(arr) for arr in
+                   [self.minutes, self.lineno] + [getattr(self, key) for key in self.string_keys])
+
+
+def _table_index(table, index, value):
+    """ Return index of value in table (a list), using and updating the index dict {value: index}. """
+    try:
+        return index[value]
+    except KeyError:
+        index[value] = len(table)
+        table.append(value)
+        return index[value]
+
+
+def timespans_to_columns(timespans_by_label):
+    """
+    Convert timespans_by_label dict to TimespanColumns.
+    Note: start and stop are stored as whole minutes, so stoptimes set to "now" for open-ended entries
+    (see find_timespans_by_label) are truncated to the minute.
+    """
+    columns = TimespanColumns()
+    tagset_index = {(): 0}
+    comment_index = {}
+    for label_id, (label, entries) in enumerate(timespans_by_label.items()):
+        columns.labels.append(label)
+        columns.start.extend(datetime_to_epoch_minutes(entry["start"]) for entry in entries)
+        columns.stop.extend(datetime_to_epoch_minutes(entry["stop"]) for entry in entries)
+        columns.label_id.extend([label_id]*len(entries))
+        columns.tags_id.extend(_table_index(columns.tagsets, tagset_index, split_tags(entry.get("tags")))
+                               for entry in entries)
+        columns.comment_id.extend(-1 if entry.get("comment") is None else
+                                  _table_index(columns.comments, comment_index, entry["comment"])
+                                  for entry in entries)
+    return columns
+
+
+def columns_to_timespans(columns):
+    """
+    Convert TimespanColumns to timespans_by_label dict (with the same label order).
+    """
+    timespans_by_label = {label: [] for label in columns.labels}
+    comments = columns.comments + [None]     # index -1 is None
+    for start, stop, label_id, tags_id, comment_id in zip(columns.start, columns.stop, columns.label_id,
+                                                          columns.tags_id, columns.comment_id):
+        label = columns.labels[label_id]
+        entry = {"label": label, "start": epoch_minutes_to_datetime(start), "stop": epoch_minutes_to_datetime(stop)}
+        entry["timespan"] = entry["stop"] - entry["start"]
+        entry["tags"] = columns.tagsets[tags_id]
+        entry["comment"] = comments[comment_id]
+        timespans_by_label[label].append(entry)
+    return timespans_by_label
+
+
+def lines_to_columns(lines):
+    """ Convert a list of line dicts, as returned by parse_files, to EventColumns. """
+    columns = EventColumns()
+    string_index = {}
+    columns.minutes.extend(datetime_to_epoch_minutes(line["datetime"]) for line in lines)
+    columns.lineno.extend(line.get("lineno", -1) for line in lines)
+    for key in columns.string_keys:
+        getattr(columns, key).extend(-1 if line.get(key) is None else
+                                     _table_index(columns.strings, string_index, line[key])
+                                     for line in lines)
+    return columns
+
+
+def columns_to_lines(columns):
+    """ Convert EventColumns to a list of line dicts, as returned by parse_files. """
+    strings = columns.strings + [None]     # index -1 is None
+    return [{"datetime": epoch_minutes_to_datetime(minutes), "action": strings[action], "label": strings[label],
+             "tags": strings[tags], "comment": strings[comment], "filename": strings[filename], "lineno": lineno}
+            for minutes, action, label, tags, comment, filename, lineno
+            in zip(columns.minutes, columns.action, columns.label, columns.tags, columns.comment,
+                   columns.filename, columns.lineno)]
+
+
+# Export formats: Row formats (jsonl, csv) are written in chunks from generators, so memory use does not
+# depend on the number of records. Columnar formats are written from TimespanColumns/EventColumns arrays:
+# parquet requires pyarrow, npz is written and read without numpy (but can be loaded with numpy.load).
+# "columnar" selects parquet if pyarrow is installed, otherwise npz.
+export_formats = ("jsonl", "csv", "parquet", "npz", "columnar")
+export_extensions = {".jsonl": "jsonl", ".ndjson": "jsonl", ".json": "jsonl", ".csv": "csv",
+                     ".parquet": "parquet", ".npz": "npz"}
+event_fields = ("datetime", "action", "label", "tags", "comment", "filename", "lineno")
+timespan_fields = ("label", "start", "stop", "minutes", "tags", "comment")
+
+
+def _format_minute(dt):
+    """ Format datetime dt as "yyyy-mm-dd HH:MM" (faster than strftime). """
+    return "%04d-%02d-%02d %02d:%02d" % (dt.year, dt.month, dt.day, dt.hour, dt.minute)
+
+
+def iter_event_records(lines):
+    """ Generate export records (dicts with event_fields and str/int values) for line dicts. """
+    for line in lines:
+        yield {"datetime": _format_minute(line["datetime"]), "action": line["action"], "label": line["label"],
+               "tags": line.get("tags") or "", "comment": line.get("comment"),
+               "filename": line.get("filename"), "lineno": line.get("lineno")}
+
+
+def iter_timespan_records(timespans_by_label):
+    """
+    Generate export records (dicts with timespan_fields and str/int values) for timespans_by_label.
+    tags is a string like "#work #fun". start and stop are truncated to whole minutes.
+    """
+    for entries in timespans_by_label.values():
+        for entry in entries:
+            yield {"label": entry["label"], "start": _format_minute(entry["start"]),
+                   "stop": _format_minute(entry["stop"]), "minutes": entry["timespan"] // timedelta(minutes=1),
+                   "tags": " ".join("#" + tag for tag in split_tags(entry.get("tags"))),
+                   "comment": entry.get("comment")}
+
+
+def resolve_export_format(filename, fmt=None):
+    """ Return the export format for filename: fmt, or the format given by the file extension if fmt is None. """
+    if fmt is None:
+        fmt = export_extensions.get(os.path.splitext(filename)[1].lower())
+        if fmt is None:
+            raise ValueError("Cannot determine export format from file extension of %r, please specify one of %s."
+                             % (filename, ", ".join(export_formats)))
+    if fmt == "columnar":
+        try:
+            import pyarrow    # pylint: disable=W0611
+            fmt = "parquet"
+        except ImportError:
+            fmt = "npz"
+    if fmt not in export_formats:
+        raise ValueError("Unknown export format %r, must be one of %s." % (fmt, ", ".join(export_formats)))
+    return fmt
+
+
+def write_records(records, filename, fields, fmt="jsonl", chunksize=10000):
+    """
+    Write records (an iterable of dicts with fields) to filename as JSON Lines or CSV (with a header line),
+    chunksize records at a time. None is written as null in JSON and as an empty field in CSV.
+    Returns the number of records written.
+    """
+    nrecords = 0
+    with open(filename, "w", encoding="utf-8", newline="") as filep:
+        if fmt == "csv":
+            import csv
+            writer = csv.writer(filep, lineterminator="\n")
+            writer.writerow(fields)
+            write_chunk = lambda chunk: writer.writerows([record[field] for field in fields] for record in chunk)
+        elif fmt == "jsonl":
+            encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+            write_chunk = lambda chunk: filep.write("".join([encode(record) + "\n" for record in chunk]))
+        else:
+            raise ValueError("Unknown record format %r, must be jsonl or csv." % fmt)
+        records = iter(records)
+        for chunk in iter(lambda: list(itertools.islice(records, chunksize)), []):
+            write_chunk(chunk)
+            nrecords += len(chunk)
+    return nrecords
+
+
+def read_records(filename, fmt="jsonl"):
+    """ Generate records (dicts) from a JSON Lines or CSV file written by write_records. """
+    with open(filename, encoding="utf-8", newline="") as filep:
+        if fmt == "csv":
+            import csv
+            for record in csv.DictReader(filep):
+                yield {key: value if value != "" or key in ("tags", "label") else None for key, value in record.items()}
+        elif fmt == "jsonl":
+            for line in filep:
+                yield json.loads(line)
+        else:
+            raise ValueError("Unknown record format %r, must be jsonl or csv." % fmt)
+
+
+def _columns_tables(columns):
+    """ Return (kind, {name: array}, {name: list of strings}) for EventColumns or TimespanColumns. """
+    if isinstance(columns, EventColumns):
+        return ("events", {name: getattr(columns, name) for name in ("minutes", "lineno") + columns.string_keys},
+                {"strings": columns.strings})
+    return ("timespans", {name: getattr(columns, name) for name in ("start", "stop", "label_id", "tags_id",
+                                                                     "comment_id")},
+            {"labels": columns.labels, "comments": columns.comments,
+             "tagsets": [" ".join("#" + tag for tag in tagset) for tagset in columns.tagsets]})
+
+
+def _npy_bytes(descr, shape, data):
+    """ Return the contents of a .npy file (format version 1.0) with the given dtype descr, shape and data. """
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%s,), }" % (descr, shape)
+    header += " " * (63 - (len(header) + 10) % 64) + "\n"
+    return b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header.encode("latin1") + data
+
+
+def write_columns_npz(columns, filename):
+    """
+    Write EventColumns or TimespanColumns to a compressed .npz file (without requiring numpy).
+    Each array is stored as an integer .npy array, and each string table as a unicode .npy array.
+    The file can be read with read_columns_npz, or with numpy.load.
+    """
+    import zipfile
+    kind, arrays, tables = _columns_tables(columns)
+    endian = "<" if sys.byteorder == "little" else ">"
+    with zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED) as zipf:
+        for name, arr in arrays.items():
+            zipf.writestr(name + ".npy", _npy_bytes("%si%s" % (endian, arr.itemsize), len(arr), arr.tobytes()))
+        for name, strings in dict(tables, kind=[kind]).items():
+            width = max([len(string) for string in strings] + [1])
+            data = b"".join(string.encode("utf-32-le").ljust(4*width, b"\0") for string in strings)
+            zipf.writestr(name + ".npy", _npy_bytes("<U%s" % width, len(strings), data))
+
+
+def read_columns_npz(filename):
+    """ Read EventColumns or TimespanColumns from a .npz file written by write_columns_npz. """
+    import ast
+    import zipfile
+    values = {}
+    with zipfile.ZipFile(filename) as zipf:
+        for name in zipf.namelist():
+            data = zipf.read(name)
+            if data[:6] != b"\x93NUMPY":
+                raise ValueError("%s in %s is not a .npy file." % (name, filename))
+            header_len = int.from_bytes(data[8:10], "little")
+            header = ast.literal_eval(data[10:10+header_len].decode("latin1"))
+            descr, body = header["descr"], data[10+header_len:]
+            if descr[1] == "U":
+                width = 4*int(descr[2:])
+                values[name[:-4]] = [body[i:i+width].decode("utf-32-le").rstrip("\0")
+                                     for i in range(0, len(body), width)]
+            else:
+                arr = array({8: "q", 4: "i"}[int(descr[2:])])
+                arr.frombytes(body)
+                if (descr[0] == "<") != (sys.byteorder == "little"):
+                    arr.byteswap()
+                values[name[:-4]] = arr
+    kind = values.pop("kind", [None])[0]
+    if kind == "events":
+        columns = EventColumns()
+    elif kind == "timespans":
+        columns = TimespanColumns()
+        values["tagsets"] = [split_tags(tagset) for tagset in values["tagsets"]]
+    else:
+        raise ValueError("%s is not a timetracker export file." % filename)
+    for name, value in values.items():
+        setattr(columns, name, value)
+    return columns
+
+
+def write_columns_parquet(columns, filename):
+    """
+    Write EventColumns or TimespanColumns to a parquet file (requires pyarrow), with one row per event or
+    timespan, timestamps as timestamp[s] columns and strings as dictionary-encoded columns.
+    """
+    import pyarrow
+    import pyarrow.parquet
+    kind, arrays, tables = _columns_tables(columns)
+    def int_column(arr):
+        """ Return pyarrow int64 array for array module arr. """
+        return pyarrow.array(arr, pyarrow.int64())
+    def timestamp_column(minutes):
+        """ Return pyarrow timestamp array for array of epoch minutes. """
+        return pyarrow.array([value*60 for value in minutes], pyarrow.int64()).cast(pyarrow.timestamp("s"))
+    def string_column(ids, strings):
+        """ Return dictionary-encoded pyarrow array with strings[id] for each id in ids (null for -1). """
+        indices = pyarrow.array([None if i < 0 else i for i in ids] if min(ids, default=0) < 0 else ids,
+                                pyarrow.int32())
+        return pyarrow.DictionaryArray.from_arrays(indices, pyarrow.array(strings, pyarrow.string()))
+    if kind == "events":
+        strings = tables["strings"]
+        data = {"datetime": timestamp_column(arrays["minutes"])}
+        data.update((name, string_column(arrays[name], strings)) for name in ("action", "label", "tags", "comment",
+                                                                              "filename"))
+        data["lineno"] = int_column(arrays["lineno"])
+    else:
+        data = {"label": string_column(arrays["label_id"], tables["labels"]),
+                "start": timestamp_column(arrays["start"]), "stop": timestamp_column(arrays["stop"]),
+                "minutes": int_column(array("q", (stop - start for start, stop in zip(arrays["start"],
+                                                                                      arrays["stop"])))),
+                "tags": string_column(arrays["tags_id"], tables["tagsets"]),
+                "comment": string_column(arrays["comment_id"], tables["comments"])}
+    table = pyarrow.table(data).replace_schema_metadata({"timetracker": kind})
+    pyarrow.parquet.write_table(table, filename)
+
+
+def read_parquet_records(filename):
+    """ Return (kind, list of records) for a parquet file written by write_columns_parquet (requires pyarrow). """
+    import pyarrow.parquet
+    table = pyarrow.parquet.read_table(filename)
+    kind = (table.schema.metadata or {}).get(b"timetracker", b"").decode()
+    if kind not in ("events", "timespans"):
+        raise ValueError("%s is not a timetracker export file." % filename)
+    columns = {name: table.column(name).to_pylist() for name in table.column_names}
+    return kind, [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+
+def export_events(lines, filename, fmt=None, chunksize=10000):
+    """
+    Export line dicts, as returned by parse_files, to filename in the given format (see export_formats;
+    default: determined by the file extension). Returns the number of events exported.
+    """
+    fmt = resolve_export_format(filename, fmt)
+    if fmt in ("jsonl", "csv"):
+        return write_records(iter_event_records(lines), filename, event_fields, fmt, chunksize)
+    columns = lines_to_columns(lines)
+    (write_columns_parquet if fmt == "parquet" else write_columns_npz)(columns, filename)
+    return len(columns)
+
+
+def export_timespans(timespans_by_label, filename, fmt=None, chunksize=10000):
+    """
+    Export timespans_by_label to filename in the given format (see export_formats; default: determined by
+    the file extension). Returns the number of timespans exported.
+    """
+    fmt = resolve_export_format(filename, fmt)
+    if fmt in ("jsonl", "csv"):
+        return write_records(iter_timespan_records(timespans_by_label), filename, timespan_fields, fmt, chunksize)
+    columns = timespans_to_columns(timespans_by_label)
+    (write_columns_parquet if fmt == "parquet" else write_columns_npz)(columns, filename)
+    return len(columns)
+
+
+def _parse_minute(value):
+    """ Parse "yyyy-mm-dd HH:MM" (or a datetime, e.g. from parquet) to datetime. """
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+
+def load_events(filename, fmt=None):
+    """ Load line dicts (as returned by parse_files) from a file written by export_events. """
+    fmt = resolve_export_format(filename, fmt)
+    if fmt == "npz":
+        columns = read_columns_npz(filename)
+        if not isinstance(columns, EventColumns):
+            raise ValueError("%s does not contain events." % filename)
+        return columns_to_lines(columns)
+    if fmt == "parquet":
+        kind, records = read_parquet_records(filename)
+        if kind != "events":
+            raise ValueError("%s does not contain events." % filename)
+    else:
+        records = read_records(filename, fmt)
+    return [{"datetime": _parse_minute(record["datetime"]), "action": record["action"], "label": record["label"],
+             "tags": record["tags"], "comment": record["comment"], "filename": record["filename"],
+             "lineno": None if record["lineno"] is None else int(record["lineno"])} for record in records]
+
+
+def load_timespans(filename, fmt=None):
+    """ Load timespans_by_label (as returned by find_timespans_by_label) from a file written by export_timespans. """
+    fmt = resolve_export_format(filename, fmt)
+    if fmt == "npz":
+        columns = read_columns_npz(filename)
+        if not isinstance(columns, TimespanColumns):
+            raise ValueError("%s does not contain timespans." % filename)
+        return columns_to_timespans(columns)
+    if fmt == "parquet":
+        kind, records = read_parquet_records(filename)
+        if kind != "timespans":
+            raise ValueError("%s does not contain timespans." % filename)
+    else:
+        records = read_records(filename, fmt)
+    timespans_by_label = defaultdict(list)
+    for record in records:
+        start, stop = _parse_minute(record["start"]), _parse_minute(record["stop"])
+        timespans_by_label[record["label"]].append({"label": record["label"], "start": start, "stop": stop,
+                                                    "timespan": stop - start, "tags": split_tags(record["tags"]),
+                                                    "comment": record["comment"]})
+    return dict(timespans_by_label)
+
+
+class LabelIntervalIndex(object):
+    """
+    Index of the timespan entries of a single label, for time range and overlap queries.
+    The entries are kept sorted by start time, with the list of start times (for bisection),
+    stop times, and the running maximum of the stop times (max_stops[i] is the latest stop time
+    of entries[:i+1]), which bounds which entries can end after a given time.
+    Queries thus cost O(log n + k), where k is the number of entries between the bounds found
+    by bisection.
+    """
+    __slots__ = ("entries", "starts", "stops", "max_stops")
+
+    def __init__(self, entries=()):
+        self.entries = sorted(entries, key=itemgetter("start"))
+        self.starts = [entry["start"] for entry in self.entries]
+        self.stops = [entry["stop"] for entry in self.entries]
+        self.max_stops = list(itertools.accumulate(self.stops, max))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def append(self, entry):
+        """ Add entry in O(1) time. The entry must not start before the last entry in the index. """
+        if self.starts and entry["start"] < self.starts[-1]:
+            raise ValueError("Cannot append entry %s, which starts before the last entry." % (entry,))
+        self.entries.append(entry)
+        self.starts.append(entry["start"])
+        self.stops.append(entry["stop"])
+        self.max_stops.append(max(self.max_stops[-1], entry["stop"]) if self.max_stops else entry["stop"])
+
+    def query(self, start_after=None, start_before=None, end_after=None, end_before=None,
+              window_start=None, window_end=None):
+        """
+        Return list of entries matching all of the given criteria (criteria that are None are not used):
+            start_after/start_before: entry start is at or after/before this time.
+            end_after/end_before: entry stop is at or after/before this time.
+            window_start/window_end: entry overlaps the window, i.e. stops after window_start and
+                starts before window_end. Entries crossing the window boundaries are clipped to the window
+                (returned as new entry dicts).
+        """
+        lo, hi = 0, len(self.entries)
+        if start_after is not None:
+            lo = max(lo, bisect.bisect_left(self.starts, start_after))
+        if start_before is not None:
+            hi = min(hi, bisect.bisect_right(self.starts, start_before))
+        if end_before is not None:
+            # Entries ending before end_before also start before it:
+            hi = min(hi, bisect.bisect_right(self.starts, end_before))
+        if end_after is not None:
+            # None of the entries before the first max_stop >= end_after end after end_after:
+            lo = max(lo, bisect.bisect_left(self.max_stops, end_after))
+        if window_end is not None:
+            hi = min(hi, bisect.bisect_left(self.starts, window_end))
+        if window_start is not None:
+            lo = max(lo, bisect.bisect_right(self.max_stops, window_start))
+        entries, stops = self.entries, self.stops
+        indices = range(lo, hi)
+        if end_after is not None:
+            indices = [i for i in indices if stops[i] >= end_after]
+        if end_before is not None:
+            indices = [i for i in indices if stops[i] <= end_before]
+        if window_start is not None:
+            indices = [i for i in indices if stops[i] > window_start]
+        if window_start is None and window_end is None:
+            return [entries[i] for i in indices]
+        return [clip_timespan(entries[i], window_start, window_end) for i in indices]
+
+
+def clip_timespan(entry, window_start=None, window_end=None):
+    """ Return entry clipped to the time window, as a new entry dict if it is clipped. """
+    start, stop = entry["start"], entry["stop"]
+    if window_start is not None and start < window_start:
+        start = window_start
+    if window_end is not None and stop > window_end:
+        stop = window_end
+    if start == entry["start"] and stop == entry["stop"]:
+        return entry
+    return dict(entry, start=start, stop=stop, timespan=stop-start)
+
+
+def build_interval_index(timespans_by_label):
+    """ Return dict with {label: LabelIntervalIndex} for timespans_by_label. """
+    return {label: LabelIntervalIndex(entries) for label, entries in timespans_by_label.items()}
+
+
+class TagIndex(object):
+    """
+    Inverted index from tags to timespans, for tag queries on many timespans.
+    The timespans of timespans_by_label are numbered in label order (timespan ids), and each tag has
+    a posting list: the sorted array of ids of the timespans with that tag. Queries are answered by
+    union and intersection of the posting lists of the queried tags, so they only touch the ids of
+    timespans with those tags instead of scanning all timespans.
+    """
+    __slots__ = ("labels", "entries", "offsets", "postings")
+
+    def __init__(self, timespans_by_label):
+        self.labels = list(timespans_by_label)
+        self.entries = []
+        self.offsets = []   # entries[offsets[i]:offsets[i+1]] are the timespans of labels[i]
+        postings = defaultdict(list)
+        for label in self.labels:
+            self.offsets.append(len(self.entries))
+            for timespan_id, entry in enumerate(timespans_by_label[label], len(self.entries)):
+                for tag in split_tags(entry.get("tags")):
+                    postings[tag].append(timespan_id)
+            self.entries.extend(timespans_by_label[label])
+        self.offsets.append(len(self.entries))
+        self.postings = {tag: array("i", ids) for tag, ids in postings.items()}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def ids(self, tags=None, exclude_tags=None, match_all=False):
+        """
+        Return sorted list of ids of timespans with any of tags (or all of them, if match_all is True)
+        and none of exclude_tags. If tags is not given, all timespans without exclude_tags are included.
+        Tags can be given as a list or a string, e.g. "#work #fun" (see split_tags); tags that normalize
+        to no tags at all (e.g. "#") are treated as no tag filter.
+        """
+        ids = None
+        tags, exclude_tags = split_tags(tags), split_tags(exclude_tags)
+        if tags:
+            postings = sorted((self.postings.get(tag, ()) for tag in tags), key=len)
+            if match_all:
+                ids = set(postings[0]).intersection(*postings[1:])
+            else:
+                ids = set().union(*postings)
+        if exclude_tags:
+            excluded = set().union(*(self.postings.get(tag, ()) for tag in exclude_tags))
+            if ids is None:
+                ids = set(range(len(self.entries)))
+            ids -= excluded
+        return list(range(len(self.entries))) if ids is None else sorted(ids)
+
+    def select(self, tags=None, exclude_tags=None, match_all=False):
+        """ Return dict with {label: [timespan entries]} for the timespans selected by ids(...). """
+        ids = self.ids(tags, exclude_tags, match_all)
+        entries, offsets = self.entries, self.offsets
+        timespans_by_label = {}
+        for i, label in enumerate(self.labels):
+            lo, hi = bisect.bisect_left(ids, offsets[i]), bisect.bisect_left(ids, offsets[i+1])
+            timespans_by_label[label] = [entries[timespan_id] for timespan_id in ids[lo:hi]]
+        return timespans_by_label
+
+
+def filter_tags(timespans_by_label, args, tag_index=None):
+    """
+    Filter timespans by the tags, exclude_tags and match_all_tags items in args (see TagIndex.ids).
+    tag_index is an optional TagIndex for timespans_by_label (or a superset of it, e.g. before filtering
+    by labels), e.g. when making multiple queries on the same timespans.
+    """
+    if not split_tags(args.get("tags")) and not split_tags(args.get("exclude_tags")):
+        return timespans_by_label
+    if tag_index is None:
+        tag_index = TagIndex(timespans_by_label)
+    logger.debug("Filtering timespans_by_label on tags %s, excluding tags %s",
+                 args.get("tags"), args.get("exclude_tags"))
+    selected = tag_index.select(args.get("tags"), args.get("exclude_tags"), match_all=args.get("match_all_tags"))
+    return {label: selected.get(label, []) for label in timespans_by_label}
+
+
+def filter_timespans(timespans_by_label, args, index=None):
+    """
+    Filter timespans by criteria in args, e.g. start/end time.
+    The time criteria are start_before, start_after, end_before, end_after (see LabelIntervalIndex.query),
+    and window_start/window_end, which selects timespans overlapping the window and clips them to it.
+    Filtering is done with an interval index, which can be given as index (as returned by
+    build_interval_index for timespans_by_label), e.g. when making multiple queries on the same timespans.
+    """
+    time_criteria = ("start_before", "start_after", "end_before", "end_after", "window_start", "window_end")
     if not any(args.get(criteria) for criteria in time_criteria):
         logger.debug("No time criteria specified... %s", args)
         return timespans_by_label
-    timespans_before_filtering = len([timespan for timespans in timespans_by_label.values() for timespan in timespans])
-    for criteria in time_criteria:
-        if not args.get(criteria):
-            continue
-        logger.debug("Filtering timespans_by_label on %s %s", criteria, args[criteria])
-        crit_key, side = criteria.split("_")
-        if side == "after":
-            time_ok = lambda timespan: timespan[crit_key] >= args[criteria]     # pylint: disable=W0640
-        elif side == "before":
-            time_ok = lambda timespan: timespan[crit_key] <= args[criteria]     # pylint: disable=W0640
-        else:
-            print("COULD NOT PARSE criteria %s -- %s, %s" % (criteria, crit_key, side))
-        timespans_by_label = {label: [timespan for timespan in timespans if time_ok(timespan)]
-                              for label, timespans in timespans_by_label.items()}
-    timespans_after_filtering = len([timespan for timespans in timespans_by_label.values() for timespan in timespans])
-    logger.debug("Timespans before/after filtering: %s / %s", timespans_before_filtering, timespans_after_filtering)
-    return timespans_by_label
+    criteria = {criteria: args[criteria] for criteria in time_criteria if args.get(criteria)}
+    logger.debug("Filtering timespans_by_label on %s", criteria)
+    if index is None:
+        index = build_interval_index(timespans_by_label)
+    filtered = {label: index[label].query(**criteria) for label in timespans_by_label}
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Timespans before/after filtering: %s / %s",
+                     sum(len(timespans) for timespans in timespans_by_label.values()),
+                     sum(len(timespans) for timespans in filtered.values()))
+    return filtered
 
 def filter_labels(timespans_by_label, args):
-    """ Filter timespans by labels in args. """
-    if args.get("labels"):
-        args["labels"] = [label.title() for label in args["labels"]] # ensure title case comparison
-        logger.debug("Including only labels: %s", args["labels"])
-        # Need to make list, otherwise we get RuntimeError for changing dict size while iterating over it
-        for key in list(timespans_by_label.keys()):
-            if key not in args["labels"]:
-                logger.debug("Removing timespans for label %s", key)
-                timespans_by_label.pop(key)
-    if args.get("exclude_labels"):
-        args["exclude_labels"] = [label.title() for label in args["exclude_labels"]]
-        logger.debug("Excluding labels: %s", args["exclude_labels"])
-        for key in list(timespans_by_label.keys()):
-            if key in args["exclude_labels"]:
-                logger.debug("Removing timespans for label %s", key)
-                timespans_by_label.pop(key)
-    return timespans_by_label
+    """
+    Return timespans_by_label with only the labels in args["labels"] (if given) and without the labels in
+    args["exclude_labels"]. Labels are compared in title case. Neither timespans_by_label nor args are modified.
+    """
+    labels = {label.title() for label in args["labels"]} if args.get("labels") else None
+    exclude_labels = {label.title() for label in args.get("exclude_labels") or ()}
+    if labels is None and not exclude_labels:
+        return timespans_by_label
+    logger.debug("Including only labels: %s, excluding labels: %s", labels, exclude_labels)
+    return {label: entries for label, entries in timespans_by_label.items()
+            if (labels is None or label in labels) and label not in exclude_labels}
 
 def filter_empty(timespans_by_label):
-    """ Remove zero-length items in timespans_by_labels (can happen after filtering by start/end time). """
-    for key in list(timespans_by_label.keys()):
-        if not timespans_by_label[key]:
-            logger.debug("Removing label with zero timespans: %s", key)
-            timespans_by_label.pop(key)
-    return timespans_by_label
+    """ Return timespans_by_label without labels with zero timespans (can happen after filtering by start/end time). """
+    return {label: entries for label, entries in timespans_by_label.items() if entries}
+
+def filter_main(timespans_by_label, args, index=None, tag_index=None):
+    """
+    Perform all filtering, as specified by args. Returns a new dict (the timespan entries are shared
+    with timespans_by_label, except for entries clipped to a time window); neither timespans_by_label
+    nor args are modified.
+    index is an optional interval index for timespans_by_label, see filter_timespans.
+    tag_index is an optional TagIndex for timespans_by_label, see filter_tags.
+    (index is not used when filtering by tags, since it indexes the timespans before filtering.)
+    """
+    timespans_by_label = filter_labels(timespans_by_label, args)
+    if split_tags(args.get("tags")) or split_tags(args.get("exclude_tags")):
+        timespans_by_label = filter_tags(timespans_by_label, args, tag_index=tag_index)
+        index = None
+    timespans_by_label = filter_timespans(timespans_by_label, args, index=index)
+    if args.get("discart_empty_labels"):
+        return filter_empty(timespans_by_label)
+    return dict(timespans_by_label)
+
+
+filter_arg_keys = ("labels", "exclude_labels", "tags", "exclude_tags", "match_all_tags", "start_before",
+                   "start_after", "end_before", "end_after", "window_start", "window_end", "discart_empty_labels")
 
-def filter_main(timespans_by_label, args):
-    """ Perform all filtering, as specified by args. """
-    filter_labels(timespans_by_label, args)
-    timespans_by_label = filter_timespans(timespans_by_label, args)
-    if args["discart_empty_labels"]:
-        filter_empty(timespans_by_label)
-    return timespans_by_label
 
-def plot_timeline(timespans_by_label):
+def normalize_filter_args(args):
+    """
+    Return a hashable, normalized version of the filter_main arguments in args, so that equivalent
+    arguments give the same key, e.g. labels in any order or case, or tags with or without '#'.
+    """
+    key = []
+    for name in filter_arg_keys:
+        value = args.get(name)
+        if not value:
+            continue
+        if name in ("labels", "exclude_labels"):
+            value = frozenset(label.title() for label in value)
+        elif name in ("tags", "exclude_tags"):
+            value = frozenset(split_tags(value))
+            if not value:
+                continue
+        elif name == "match_all_tags":
+            if not split_tags(args.get("tags")):
+                continue
+            value = True
+        elif name == "discart_empty_labels":
+            value = True
+        key.append((name, value))
+    return tuple(key)
+
+
+def timespans_fingerprint(timespans_by_label, deep=True):
+    """
+    Return a fingerprint of timespans_by_label, which changes when the timespans change.
+    By default (deep=True), all start and stop times, tags and comments are included, so a change of any
+    timespan is detected. If deep is False, the fingerprint is only calculated from the labels, the number
+    of timespans of each label and the first and last timespans of each label, so it costs O(number of
+    labels), but changes of other timespans (e.g. a corrected stop time) are not detected.
+    """
+    def edges(entries):
+        """ Return the start and stop of the first and last entries. """
+        return ((entries[0]["start"], entries[0]["stop"], entries[-1]["start"], entries[-1]["stop"])
+                if entries else ())
+    if deep:
+        return hash(tuple((label, tuple((entry["start"], entry["stop"], entry.get("tags"), entry.get("comment"))
+                                        for entry in entries))
+                          for label, entries in timespans_by_label.items()))
+    return hash(tuple((label, len(entries), edges(entries)) for label, entries in timespans_by_label.items()))
+
+
+class QueryCache(object):
+    """
+    Memoised filter_main queries on timespans_by_label, e.g. for interactive use where the same filter
+    combinations are used repeatedly. Results are cached in an LRU cache with at most maxsize entries,
+    with key given by the normalized filter arguments (see normalize_filter_args). The interval index
+    and tag index used for filtering are also kept, so a query that is not cached does not re-build them.
+
+    The cache is for one data set at a time: Each query is given a version of the data, and if it has
+    changed, all cached results and indexes are discarded. The version can be given explicitly, e.g. the
+    sizes and modification times of the files the timespans were parsed from, or TimeTracker.nevents.
+    Otherwise, it is the fingerprint of timespans_by_label (see timespans_fingerprint, with deep=deep),
+    which takes O(number of timespans) time with deep=True (the default).
+    Cached results are shared between queries, so they must not be modified.
+    """
+
+    def __init__(self, maxsize=128, deep=True):
+        from collections import OrderedDict
+        self.maxsize = maxsize
+        self.deep = deep
+        self.results = OrderedDict()
+        self.fingerprint = None
+        self.index = self.tag_index = None
+        self.hits = self.misses = 0
+
+    def clear(self):
+        """ Discard all cached results and indexes. """
+        self.results.clear()
+        self.fingerprint = None
+        self.index = self.tag_index = None
+
+    def query(self, timespans_by_label, args, version=None):
+        """
+        Return filter_main(timespans_by_label, args), using the cached result if available.
+        version is the version of timespans_by_label (see QueryCache); if None, the fingerprint is used.
+        """
+        fingerprint = ("version", version) if version is not None else \
+            timespans_fingerprint(timespans_by_label, self.deep)
+        if fingerprint != self.fingerprint:
+            if self.fingerprint is not None:
+                logger.debug("Timespans have changed, clearing query cache.")
+            self.clear()
+            self.fingerprint = fingerprint
+        key = normalize_filter_args(args)
+        try:
+            result = self.results[key]
+        except KeyError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.results.move_to_end(key)
+            return result
+        args = dict(key)
+        if args.get("tags") or args.get("exclude_tags"):
+            if self.tag_index is None:
+                self.tag_index = TagIndex(timespans_by_label)
+        elif self.index is None and any(name in args for name in ("start_before", "start_after", "end_before",
+                                                                   "end_after", "window_start", "window_end")):
+            self.index = build_interval_index(timespans_by_label)
+        result = self.results[key] = filter_main(timespans_by_label, args, index=self.index,
+                                                 tag_index=self.tag_index)
+        if len(self.results) > self.maxsize:
+            self.results.popitem(last=False)
+        return result
+
+
+report_groupings = ("label", "tag", "day", "week", "month", "hour-of-week")
+report_formats = ("table", "csv", "json")
+weekday_names = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
+
+def _report_bins(group_by, first, last):
+    """
+    Return (edges, bin_groups, groups) for time bins covering epoch minutes first to last:
+    Bin i is the time from edges[i] to edges[i+1] (epoch minutes), and belongs to the group
+    groups[bin_groups[i]]. For hour-of-week, the same hour in different weeks is the same group.
+    """
+    monday = -3*1440    # 1970-01-01 is a Thursday.
+    if group_by == "day":
+        edges = [day*1440 for day in range(first // 1440, last // 1440 + 2)]
+        groups = [epoch_minutes_to_datetime(edge).strftime("%Y-%m-%d") for edge in edges[:-1]]
+    elif group_by == "week":
+        edges = [week*10080 + monday for week in range((first - monday) // 10080, (last - monday) // 10080 + 2)]
+        groups = ["%04d-W%02d" % epoch_minutes_to_datetime(edge).isocalendar()[:2] for edge in edges[:-1]]
+    elif group_by == "month":
+        first_dt, last_dt = epoch_minutes_to_datetime(first), epoch_minutes_to_datetime(last)
+        months = range(first_dt.year*12 + first_dt.month - 1, last_dt.year*12 + last_dt.month + 1)
+        edges = [datetime_to_epoch_minutes(datetime(month // 12, month % 12 + 1, 1)) for month in months]
+        groups = ["%04d-%02d" % (month // 12, month % 12 + 1) for month in months[:-1]]
+    elif group_by == "hour-of-week":
+        edges = [hour*60 for hour in range(first // 60, last // 60 + 2)]
+        groups = ["%s %02d:00" % (weekday_names[hour // 24], hour % 24) for hour in range(168)]
+        return edges, [((edge - monday) // 60) % 168 for edge in edges[:-1]], groups
+    else:
+        raise ValueError("Unknown report grouping %r, must be one of %s." % (group_by, ", ".join(report_groupings)))
+    return edges, range(len(groups)), groups
+
+
+def _split_by_bins(start, stop, edges):
+    """
+    Split the spans from start[i] to stop[i] (sequences of epoch minutes) at the bin edges.
+    Returns (bins, durations), with the bin index and duration (minutes) of each piece.
+    Uses numpy if it is available, otherwise bisection for each span.
+    """
+    try:
+        import numpy
+    except ImportError:
+        bins, durations = [], []
+        for span_start, span_stop in zip(start, stop):
+            first = bisect.bisect_right(edges, span_start) - 1
+            last = max(first, bisect.bisect_left(edges, span_stop) - 1)
+            for i in range(first, last + 1):
+                bins.append(i)
+                durations.append(min(span_stop, edges[i+1]) - max(span_start, edges[i]))
+        return bins, durations
+    start, stop, edges = (numpy.frombuffer(start, dtype=numpy.int64), numpy.frombuffer(stop, dtype=numpy.int64),
+                          numpy.asarray(edges, dtype=numpy.int64))
+    first = numpy.searchsorted(edges, start, side="right") - 1
+    last = numpy.maximum(first, numpy.searchsorted(edges, stop, side="left") - 1)
+    npieces = last - first + 1
+    span_idx = numpy.repeat(numpy.arange(len(start)), npieces)
+    # Piece number within each span, added to the first bin of the span:
+    bins = first[span_idx] + numpy.arange(len(span_idx)) - numpy.repeat(numpy.cumsum(npieces) - npieces, npieces)
+    durations = numpy.minimum(stop[span_idx], edges[bins+1]) - numpy.maximum(start[span_idx], edges[bins])
+    return bins, durations
+
+
+def _group_totals(group_ids, durations, ngroups):
+    """ Return lists with the sum of durations and the number of items for each group id. """
+    try:
+        import numpy
+    except ImportError:
+        totals, counts = [0]*ngroups, [0]*ngroups
+        for group_id, duration in zip(group_ids, durations):
+            totals[group_id] += duration
+            counts[group_id] += 1
+        return totals, counts
+    group_ids = numpy.asarray(group_ids, dtype=numpy.intp)
+    totals = numpy.bincount(group_ids, weights=numpy.asarray(durations, dtype=numpy.float64), minlength=ngroups)
+    return totals.round().astype(numpy.int64).tolist(), numpy.bincount(group_ids, minlength=ngroups).tolist()
+
+
+def report_totals(timespans_by_label, group_by="label"):
+    """
+    Calculate total time and number of timespans for each group, where group_by is one of:
+        label, tag: Group by label or by tag (a timespan counts for each of its tags; spans without tags
+            are grouped as "(untagged)").
+        day, week, month: Group by calendar day, ISO week or month. Timespans crossing the boundary
+            between two days/weeks/months are split, and count in both.
+        hour-of-week: Group by hour of the week (e.g. "Mon 08:00"), summed over all weeks.
+    Returns list of dicts with group, minutes (total), hours (total) and count, sorted by group
+    (in time order for the time groupings). Groups without timespans are not included.
+    """
+    columns = timespans_to_columns(timespans_by_label)
+    if not len(columns):
+        return []
+    if group_by == "label":
+        groups, group_ids = columns.labels, columns.label_id
+        durations = [stop - start for start, stop in zip(columns.start, columns.stop)]
+    elif group_by == "tag":
+        groups = sorted({tag for tagset in columns.tagsets for tag in tagset}) + ["(untagged)"]
+        group_index = {group: i for i, group in enumerate(groups)}
+        tagset_group_ids = [[group_index[tag] for tag in tagset] or [len(groups) - 1] for tagset in columns.tagsets]
+        group_ids, durations = [], []
+        for start, stop, tags_id in zip(columns.start, columns.stop, columns.tags_id):
+            for group_id in tagset_group_ids[tags_id]:
+                group_ids.append(group_id)
+                durations.append(stop - start)
+    else:
+        edges, bin_groups, groups = _report_bins(group_by, min(columns.start), max(columns.stop))
+        bins, durations = _split_by_bins(columns.start, columns.stop, edges)
+        try:
+            import numpy
+            group_ids = numpy.asarray(bin_groups, dtype=numpy.intp)[bins]
+        except ImportError:
+            group_ids = [bin_groups[i] for i in bins]
+    totals, counts = _group_totals(group_ids, durations, len(groups))
+    order = sorted(range(len(groups)), key=groups.__getitem__) if group_by == "label" else range(len(groups))
+    return [{"group": groups[i], "minutes": totals[i], "hours": round(totals[i]/60, 2), "count": counts[i]}
+            for i in order if counts[i]]
+
+
+def format_report(rows, fmt="table"):
+    """ Format report rows, as returned by report_totals, as table, csv or json string. """
+    fields = ("group", "minutes", "hours", "count")
+    if fmt == "json":
+        return json.dumps(rows, indent=2)
+    if fmt == "csv":
+        import csv
+        import io
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fieldnames=fields, lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+        return out.getvalue()
+    if fmt != "table":
+        raise ValueError("Unknown report format %r, must be one of %s." % (fmt, ", ".join(report_formats)))
+    width = max([len(str(row["group"])) for row in rows] + [5])
+    lines = ["%-*s %10s %8s %6s" % (width, "Group", "Time", "Hours", "Count")]
+    lines += ["%-*s %7d:%02d %8.2f %6d" % (width, row["group"], row["minutes"] // 60, row["minutes"] % 60,
+                                          row["hours"], row["count"]) for row in rows]
+    total = sum(row["minutes"] for row in rows)
+    lines.append("%-*s %7d:%02d %8.2f %6d" % (width, "Total", total // 60, total % 60, total/60,
+                                             sum(row["count"] for row in rows)))
+    return "\n".join(lines) + "\n"
+
+
+def sweep_timespans(timespans_by_label, overlaps=True):
+    """
+    Analyze how timespans of different labels overlap, with a single sweep over the start and stop
+    times of all timespans in time order. This takes O(n log n + k) time for n timespans with k
+    overlapping pairs (if overlaps is False, the pairs are not collected).
+    Timespans of the same label are merged, i.e. a label overlapping itself is not counted as
+    concurrent, and zero-length timespans are ignored.
+
+    Returns dict with:
+        labels: {label: {"total": timedelta, "exclusive": timedelta, "shared": timedelta}}, where total is
+            the time the label was running, of which exclusive is the time it was the only running label
+            and shared is the time other labels were also running.
+        levels: {number of running labels: total timedelta}, from the first start to the last stop
+            (level 0 is the time between timespans).
+        concurrency: List of (datetime, number of running labels) for each change in the number
+            of running labels, ending with level 0 at the last stop.
+        overlaps: List of (entry, other entry, overlap start, overlap stop) for each pair of overlapping
+            timespans with different labels, where other entry starts at overlap start.
+    """
+    events = [(entry[key], is_start, label, entry)
+              for label, entries in timespans_by_label.items() for entry in entries if entry["stop"] > entry["start"]
+              for key, is_start in (("start", True), ("stop", False))]
+    # At the same time, stops come before starts, so timespans that only touch do not overlap:
+    events.sort(key=itemgetter(0, 1))
+    running = {}            # {label: number of running timespans}
+    running_since = {}      # {label: start of current running period}
+    running_entries = {}    # {label: {id(entry): entry}}, only used for overlaps
+    totals, exclusive, levels = defaultdict(timedelta), defaultdict(timedelta), defaultdict(timedelta)
+    concurrency, overlap_pairs = [], []
+    prev_time = None
+    for event_time, is_start, label, entry in events:
+        if prev_time is not None and event_time > prev_time:
+            level = len(running)
+            levels[level] += event_time - prev_time
+            if level == 1:
+                exclusive[next(iter(running))] += event_time - prev_time
+            if not concurrency or concurrency[-1][1] != level:
+                concurrency.append((prev_time, level))
+        prev_time = event_time
+        if is_start:
+            if overlaps:
+                # Only the running entries of other labels are visited, so each visited entry gives a pair:
+                overlap_pairs.extend((other, entry, event_time, min(other["stop"], entry["stop"]))
+                                     for other_label, others in running_entries.items() if other_label != label
+                                     for other in others.values())
+                running_entries.setdefault(label, {})[id(entry)] = entry
+            if label not in running:
+                running[label] = 0
+                running_since[label] = event_time
+            running[label] += 1
+        else:
+            if overlaps:
+                del running_entries[label][id(entry)]
+                if not running_entries[label]:
+                    del running_entries[label]
+            running[label] -= 1
+            if not running[label]:
+                del running[label]
+                totals[label] += event_time - running_since.pop(label)
+    if prev_time is not None:
+        concurrency.append((prev_time, 0))
+    labels = {label: {"total": totals[label], "exclusive": exclusive[label],
+                      "shared": totals[label] - exclusive[label]} for label in sorted(totals)}
+    return {"labels": labels, "levels": dict(sorted(levels.items())), "concurrency": concurrency,
+            "overlaps": overlap_pairs}
+
+
+def format_concurrency_report(result, fmt="table", max_overlaps=20):
+    """
+    Format the result of sweep_timespans as table, csv or json string.
+    The table has total, exclusive and shared time for each label, the time at each concurrency level,
+    and the max_overlaps longest overlaps. csv only has the label rows.
+    """
+    def minutes(delta):
+        """ Return whole minutes of timedelta delta. """
+        return delta // timedelta(minutes=1)
+    rows = [{"label": label, "minutes": minutes(times["total"]), "exclusive_minutes": minutes(times["exclusive"]),
+             "shared_minutes": minutes(times["shared"])} for label, times in result["labels"].items()]
+    if fmt == "json":
+        return json.dumps({"labels": rows,
+                           "levels": {level: minutes(delta) for level, delta in result["levels"].items()},
+                           "concurrency": [(changed.strftime("%Y-%m-%d %H:%M"), level)
+                                           for changed, level in result["concurrency"]],
+                           "overlaps": [{"label": entry["label"], "start": entry["start"].strftime("%Y-%m-%d %H:%M"),
+                                         "other_label": other["label"],
+                                         "other_start": other["start"].strftime("%Y-%m-%d %H:%M"),
+                                         "overlap_minutes": minutes(stop - start)}
+                                        for entry, other, start, stop in result["overlaps"]]}, indent=2)
+    if fmt == "csv":
+        import csv
+        import io
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fieldnames=("label", "minutes", "exclusive_minutes", "shared_minutes"),
+                                lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+        return out.getvalue()
+    if fmt != "table":
+        raise ValueError("Unknown report format %r, must be one of %s." % (fmt, ", ".join(report_formats)))
+    def hhmm(value):
+        """ Format minutes as H:MM. """
+        return "%d:%02d" % (value // 60, value % 60)
+    width = max([len(row["label"]) for row in rows] + [5])
+    lines = ["%-*s %10s %10s %10s" % (width, "Label", "Total", "Exclusive", "Shared")]
+    lines += ["%-*s %10s %10s %10s" % (width, row["label"], hhmm(row["minutes"]), hhmm(row["exclusive_minutes"]),
+                                       hhmm(row["shared_minutes"])) for row in rows]
+    lines += ["", "%-*s %10s" % (width, "Running", "Time")]
+    lines += ["%-*s %10s" % (width, "%s labels" % level, hhmm(minutes(delta)))
+              for level, delta in result["levels"].items()]
+    lines += ["", "%s overlapping pairs of timespans." % len(result["overlaps"])]
+    longest = heapq.nlargest(max_overlaps, result["overlaps"], key=lambda overlap: overlap[3] - overlap[2])
+    lines += ["%s  %s / %s  (%s)" % (start.strftime("%Y-%m-%d %H:%M"), entry["label"], other["label"],
+                                     hhmm(minutes(stop - start))) for entry, other, start, stop in longest]
+    return "\n".join(lines) + "\n"
+
+
+class _Span(object):
+    """ A timespan in TimeTracker. stop and stop_key (the key of the stopping event) are None while running. """
+    __slots__ = ("label", "start", "stop", "stop_key", "tags", "comment")
+
+    def __init__(self, label, start, tags=(), comment=None):
+        self.label, self.start, self.tags, self.comment = label, start, tags, comment
+        self.stop = self.stop_key = None
+
+    def entry(self, now):
+        """ Return timespan entry dict (as find_timespans_by_label), with stop set to now if running. """
+        stop = now if self.stop is None else self.stop
+        return {"label": self.label, "start": self.start, "tags": self.tags, "comment": self.comment,
+                "stop": stop, "timespan": stop - self.start}
+
+
+def _insort(keys, key, values=None, value=None):
+    """
+    Insert key in the sorted list keys (after any equal keys), and value at the same position in values
+    (if given). Returns the position. Appending, i.e. if key is not before the last key, takes O(1) time.
+    """
+    if not keys or key >= keys[-1]:
+        i = len(keys)
+        keys.append(key)
+    else:
+        i = bisect.bisect_right(keys, key)
+        keys.insert(i, key)
+    if values is not None:
+        values.insert(i, value)
+    return i
+
+
+def _bisect_spans(spans, lo, hi, condition):
+    """ Return the first index in spans[lo:hi] where condition(span) is true (condition must be monotonic). """
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if condition(spans[mid]):
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+class TimeTracker(object):
+    """
+    Incrementally updated time tracking state, with running activities, completed timespans and total
+    time for each label, for events (start/stop lines) that are added one at a time, e.g. from a message
+    queue or from lines appended to the time tracker files (see watch_files).
+
+    The timespans are the same as given by get_lines_by_label followed by find_timespans_by_label for all
+    added events, i.e. a timespan started by a start event is stopped by the first later stop event of the
+    same label or, if auto_stop_on_start is True, the first later start event of any label.
+    Events with other actions than start and stop (e.g. "pause") do not start or stop timespans, but as in
+    get_lines_by_label, the running timespans of their label are then not stopped by later start events
+    until the label is started again.
+    Events are ordered by line_sort_key; events without filename and lineno are ordered by time and then
+    by the order they are added.
+
+    Adding an event in order (not before the last added event) takes O(log n) time (O(1) to append, and
+    bisection to find the next events). An event that is out of order is inserted with bisection, and only
+    the timespans it affects are updated: the timespan it starts, and the timespans of its label (and with
+    auto_stop_on_start, of the label of the previous start event) running at the time of the event.
+    Timespans of a label running at the same time always have the same stop, so updating them stops at the
+    first timespan whose stop is unchanged.
+    Total minutes of completed timespans are kept for each label, so totals() takes O(number of labels)
+    time. timespans_by_label() returns a snapshot with the same shape as find_timespans_by_label.
+    """
+
+    def __init__(self, auto_stop_on_start=True):
+        self.auto_stop_on_start = auto_stop_on_start
+        self.clear()
+
+    def clear(self):
+        """ Remove all events and timespans. """
+        self.nevents = 0
+        self.start_keys, self.start_spans = [], []  # Keys and spans of all start events, sorted by key.
+        self.label_start_keys = defaultdict(list)   # {label: sorted keys of start events}
+        self.label_spans = defaultdict(list)        # {label: spans in the same order}
+        self.label_stop_keys = defaultdict(list)    # {label: sorted keys of stop events}
+        self.label_other_keys = defaultdict(list)   # {label: sorted keys of events with other actions}
+        self.running = set()                        # Spans without stop.
+        self.closed_minutes = defaultdict(int)      # {label: total minutes of spans with stop}
+        self._seq = 0
+
+    def __len__(self):
+        return len(self.start_spans)
+
+    def _key(self, line):
+        """ Return sort key for line (as line_sort_key, but also for lines without filename and lineno). """
+        filename, lineno = line.get("filename"), line.get("lineno")
+        if lineno is None:
+            self._seq += 1
+            lineno = self._seq
+        return (line["datetime"], filename or "", lineno, line["label"], line["action"])
+
+    def _set_stop(self, span, stop_key):
+        """ Set the stopping event of span (None if it is running), and update totals. """
+        if span.stop is not None:
+            self.closed_minutes[span.label] -= (span.stop - span.start) // timedelta(minutes=1)
+        span.stop_key = stop_key
+        span.stop = None if stop_key is None else stop_key[0]
+        if span.stop is None:
+            self.running.add(span)
+        else:
+            self.running.discard(span)
+            self.closed_minutes[span.label] += (span.stop - span.start) // timedelta(minutes=1)
+
+    def _find_stop(self, label, start_key):
+        """ Return the key of the event stopping the span of label started at start_key (None if running). """
+        stop_keys = self.label_stop_keys.get(label, ())
+        # (Checking the last key first, since the span is usually the last one when adding events in order.)
+        stop_key = None if not stop_keys or start_key >= stop_keys[-1] else \
+            stop_keys[bisect.bisect_right(stop_keys, start_key)]
+        if not self.auto_stop_on_start:
+            return stop_key
+        # The span is stopped by the next start event, unless its label has an event with another action
+        # before that. Then it is only stopped by a start event after the label is started again:
+        start_keys, label_start_keys = self.start_keys, self.label_start_keys[label]
+        other_keys = self.label_other_keys.get(label, ())
+        while True:
+            i = len(start_keys) if start_key >= start_keys[-1] else bisect.bisect_right(start_keys, start_key)
+            if i == len(start_keys) or (stop_key is not None and stop_key < start_keys[i]):
+                return stop_key
+            k = bisect.bisect_right(other_keys, start_key)
+            if k == len(other_keys) or other_keys[k] > start_keys[i]:
+                return start_keys[i]
+            n = bisect.bisect_right(label_start_keys, other_keys[k])
+            if n == len(label_start_keys):
+                return stop_key
+            start_key = label_start_keys[n]
+
+    def _update_running(self, label, key):
+        """ Update the stop of the spans of label started before, and running at, the event with key. """
+        start_keys = self.label_start_keys.get(label, ())
+        spans = self.label_spans.get(label, ())
+        i = bisect.bisect_left(start_keys, key) - 1
+        if i < 0 or (spans[i].stop_key is not None and spans[i].stop_key < key):
+            return
+        stop_key = self._find_stop(label, start_keys[i])
+        while i >= 0 and spans[i].stop_key != stop_key \
+        and (spans[i].stop_key is None or spans[i].stop_key > key):
+            self._set_stop(spans[i], stop_key)
+            i -= 1
+
+    def add_line(self, line):
+        """ Add event, given as a line dict with datetime, action and label (and optionally tags, comment etc). """
+        action, label = line["action"], line["label"]
+        key = self._key(line)
+        self.nevents += 1
+        if action == "start":
+            span = _Span(label, line["datetime"], split_tags(line.get("tags")), line.get("comment"))
+            i = _insort(self.start_keys, key, self.start_spans, span)
+            _insort(self.label_start_keys[label], key, self.label_spans[label], span)
+            self._set_stop(span, self._find_stop(label, key))
+            if self.auto_stop_on_start:
+                # The start event can stop the running spans of its label and of the previous start event:
+                self._update_running(label, key)
+                if i > 0 and self.start_spans[i-1].label != label:
+                    self._update_running(self.start_spans[i-1].label, key)
+        elif action == "stop":
+            _insort(self.label_stop_keys[label], key)
+            self._update_running(label, key)
+        else:
+            _insort(self.label_other_keys[label], key)
+            if self.auto_stop_on_start:
+                self._update_running(label, key)
+
+    def add_lines(self, lines):
+        """ Add events (see add_line) in any order. """
+        # Adding in time order uses the O(1) append path as much as possible:
+        for line in sorted(lines, key=itemgetter("datetime")):
+            self.add_line(line)
+
+    def running_labels(self):
+        """ Return sorted list of the labels of running activities. """
+        return sorted({span.label for span in self.running})
+
+    def _query(self, label, now, criteria):
+        """ Return the timespan entries of label matching criteria (see LabelIntervalIndex.query). """
+        spans = self.label_spans[label]
+        # Running spans are always last, and the stop times of the other spans are sorted, since a
+        # span is stopped by the first stop (or start) event after its start:
+        nclosed = len(spans)
+        while nclosed and spans[nclosed-1].stop is None:
+            nclosed -= 1
+        lo, hi = 0, nclosed
+        if criteria.get("start_after") is not None:
+            lo = _bisect_spans(spans, lo, hi, lambda span: span.start >= criteria["start_after"])
+        if criteria.get("start_before") is not None:
+            hi = _bisect_spans(spans, lo, hi, lambda span: span.start > criteria["start_before"])
+        if criteria.get("end_after") is not None:
+            lo = _bisect_spans(spans, lo, hi, lambda span: span.stop >= criteria["end_after"])
+        if criteria.get("end_before") is not None:
+            hi = _bisect_spans(spans, lo, hi, lambda span: span.stop > criteria["end_before"])
+        if criteria.get("window_end") is not None:
+            hi = _bisect_spans(spans, lo, hi, lambda span: span.start >= criteria["window_end"])
+        if criteria.get("window_start") is not None:
+            lo = _bisect_spans(spans, lo, hi, lambda span: span.stop > criteria["window_start"])
+        window_start, window_end = criteria.get("window_start"), criteria.get("window_end")
+        entries = [spans[i].entry(now) for i in range(lo, hi)]
+        if window_start is not None or window_end is not None:
+            entries = [clip_timespan(entry, window_start, window_end) for entry in entries]
+        running = [span.entry(now) for span in spans[nclosed:]]
+        return entries + (LabelIntervalIndex(running).query(**criteria) if criteria else running)
+
+    def timespans_by_label(self, now=None, labels=None, **criteria):
+        """
+        Return dict with {label: [timespan entries]} as find_timespans_by_label (using now as stop for
+        running activities), for all labels or the given labels.
+        criteria are the time criteria of LabelIntervalIndex.query, e.g. window_start and window_end.
+        """
+        if now is None:
+            now = datetime.now()
+        if labels is None:
+            labels = sorted(self.label_spans)
+        criteria = {key: value for key, value in criteria.items() if value is not None}
+        return {label: self._query(label, now, criteria) for label in labels if label in self.label_spans}
+
+    def totals(self, now=None, window_start=None, window_end=None):
+        """
+        Return total minutes and number of timespans for each label (overlapping the window, if given),
+        as rows like report_totals(..., group_by="label"), which can be formatted with format_report.
+        """
+        if now is None:
+            now = datetime.now()
+        if window_start is None and window_end is None:
+            running_minutes = defaultdict(int)
+            for span in self.running:
+                running_minutes[span.label] += (now - span.start) // timedelta(minutes=1)
+            rows = [{"group": label, "minutes": self.closed_minutes[label] + running_minutes[label],
+                     "count": len(spans)} for label, spans in sorted(self.label_spans.items())]
+        else:
+            timespans_by_label = self.timespans_by_label(now, window_start=window_start, window_end=window_end)
+            rows = [{"group": label, "count": len(entries),
+                     "minutes": sum(entry["timespan"] // timedelta(minutes=1) for entry in entries)}
+                    for label, entries in timespans_by_label.items() if entries]
+        for row in rows:
+            row["hours"] = round(row["minutes"]/60, 2)
+        return rows
+
+
+def tail_file(filename, offset=0, lineno=0):
+    """
+    Parse the complete lines of filename after byte offset (with parse_file_bulk), where lineno is the
+    line number of the line starting at offset. Returns (lines, offset, lineno) with the offset and line
+    number just after the last complete line, to be used for the next call when the file has grown.
+    """
+    with open(filename, "rb") as filep:
+        filep.seek(offset)
+        data = filep.read()
+    end = data.rfind(b"\n") + 1
+    if not end:
+        return [], offset, lineno
+    return parse_file_bulk(filename, offset, lineno, offset + end), offset + end, lineno + data.count(b"\n", 0, end)
+
+
+def _period_window(period, now):
+    """ Return (window_start, window_end) for the query period today, yesterday, week (last 7 days) or all. """
+    today = datetime(now.year, now.month, now.day)
+    if period == "today":
+        return today, None
+    if period == "yesterday":
+        return today - timedelta(1), today
+    if period == "week":
+        return today - timedelta(6), None
+    if period == "all":
+        return None, None
+    raise ValueError("Unknown period %r, must be one of today, yesterday, week, all." % period)
+
+
+def handle_query(state, path, params, now=None):
+    """
+    Answer a query to the watch server for the TimeTracker state. Returns a json-serializable result.
+    path is one of:
+        /totals: Total minutes and count for each label, see TimeTracker.totals.
+        /timespans: Timespans by label, see TimeTracker.timespans_by_label.
+        /status: Number of events, timespans and labels, and the currently running labels.
+    params is a dict with the query parameters (all optional):
+        period: today, yesterday, week (last 7 days) or all (default).
+        window_start, window_end: "yyyy-mm-dd HH:MM" (instead of period).
+        start_after, start_before, end_after, end_before: "yyyy-mm-dd HH:MM" (only for /timespans).
+        labels: Comma-separated labels (only for /timespans).
+    Raises KeyError for unknown paths and ValueError for invalid parameters.
+    """
+    if now is None:
+        now = datetime.now()
+    if path == "/status":
+        return {"events": state.nevents, "timespans": len(state), "labels": len(state.label_spans),
+                "running": state.running_labels()}
+    if path not in ("/totals", "/timespans"):
+        raise KeyError("Unknown query %r, must be one of /totals, /timespans, /status." % path)
+    criteria = {}
+    criteria["window_start"], criteria["window_end"] = _period_window(params.get("period", "all"), now)
+    time_criteria = ("start_before", "start_after", "end_before", "end_after", "window_start", "window_end")
+    for key in time_criteria:
+        if params.get(key):
+            criteria[key] = datetime.fromisoformat(params[key])
+    if path == "/totals":
+        return {"window_start": str(criteria["window_start"] or "") or None,
+                "window_end": str(criteria["window_end"] or "") or None,
+                "totals": state.totals(now, criteria["window_start"], criteria["window_end"])}
+    criteria = {key: value for key, value in criteria.items() if value is not None}
+    labels = [label.strip().title() for label in params["labels"].split(",")] if params.get("labels") else None
+    timespans_by_label = state.timespans_by_label(now, labels, **criteria)
+    return {"timespans": {label: [{"start": entry["start"].strftime("%Y-%m-%d %H:%M"),
+                                   "stop": entry["stop"].strftime("%Y-%m-%d %H:%M"),
+                                   "minutes": int(entry["timespan"].total_seconds() // 60),
+                                   "tags": entry["tags"], "comment": entry["comment"]}
+                                  for entry in entries]
+                          for label, entries in timespans_by_label.items()}}
+
+
+def start_query_server(state, lock, host="127.0.0.1", port=8765):
+    """
+    Start a http server answering queries (see handle_query) for the TimeTracker state,
+    in a background thread. lock must be held while the state is updated. Returns the server
+    (server.server_address gives the actual port if port is 0; call server.shutdown() to stop it).
+    """
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlsplit, parse_qs
+
+    class QueryHandler(BaseHTTPRequestHandler):
+        """ Handle GET requests with handle_query. """
+        def do_GET(self):    # pylint: disable=C0111
+            url = urlsplit(self.path)
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            try:
+                with lock:
+                    result, status = handle_query(state, url.path, params), 200
+            except KeyError as exc:
+                result, status = {"error": str(exc.args[0])}, 404
+            except ValueError as exc:
+                result, status = {"error": str(exc)}, 400
+            body = json.dumps(result).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # pylint: disable=W0622
+            logger.debug("%s - %s", self.address_string(), format % args)
+
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def watch_files(filenames, state, lock, interval=1.0, max_polls=None, positions=None):
+    """
+    Poll filenames every interval seconds and add new complete lines to the TimeTracker state.
+    Each file is read from the byte offset where the previous poll stopped, so only appended lines
+    are parsed. If a file has shrunk (e.g. it has been truncated or replaced), all files are re-read.
+    Runs until interrupted, or for max_polls polls.
+    positions is a dict with {filename: (offset, lineno)} read so far, which is updated in place
+    (pass the same dict to continue watching after returning).
+    """
+    if positions is None:
+        positions = {}
+    for filename in filenames:
+        positions.setdefault(filename, (0, 0))
+    for poll in itertools.count():
+        new_lines = []
+        for filename in filenames:
+            offset, lineno = positions[filename]
+            try:
+                size = os.path.getsize(filename)
+            except OSError:
+                continue
+            if size < offset:
+                logger.warning("File %s has shrunk, re-reading all files.", filename)
+                positions.update((filename, (0, 0)) for filename in filenames)
+                with lock:
+                    state.clear()
+                new_lines = None
+                break
+            if size > offset:
+                lines, offset, lineno = tail_file(filename, offset, lineno)
+                positions[filename] = (offset, lineno)
+                new_lines.extend(lines)
+        if new_lines:
+            with lock:
+                state.add_lines(new_lines)
+            logger.info("Added %s new lines (%s events in total).", len(new_lines), state.nevents)
+        if max_polls is not None and poll + 1 >= max_polls:
+            break
+        if new_lines is not None:
+            time.sleep(interval)
+
+
+def watch(args):
+    """ Watch the files in args and serve queries until interrupted (--watch). """
+    import threading
+    state = TimeTracker(auto_stop_on_start=args["auto_stop_on_start"])
+    lock = threading.Lock()
+    server = start_query_server(state, lock, args["watch_host"], args["watch_port"])
+    print("Watching %s files, serving queries on http://%s:%s/ (e.g. /totals?period=today)"
+          % (len(args["files"]), *server.server_address[:2]), file=sys.stderr)
+    try:
+        watch_files(args["files"], state, lock, interval=args["watch_interval"])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def decimate_timespans(entries, min_gap):
+    """
+    Return list of (start, stop) tuples for entries (sorted by start), where entries
+    separated by less than min_gap (timedelta) are merged, e.g. because they would be
+    drawn in the same pixel of a plot anyway.
+    """
+    merged = []
+    for entry in entries:
+        if merged and entry["start"] - merged[-1][1] < min_gap:
+            if entry["stop"] > merged[-1][1]:
+                merged[-1] = (merged[-1][0], entry["stop"])
+        else:
+            merged.append((entry["start"], entry["stop"]))
+    return merged
+
+
+def plot_timeline(timespans_by_label, output=None, dpi=100, decimate=True):
     """
     Make a time line with timespans by label.
 
+    The timespans of each label are drawn as a single collection of bars (broken_barh).
+    If decimate is True, timespans closer to each other than the width of a pixel are merged before drawing.
+
+    If output is given, the plot is saved to this file (the format is determined by the extension,
+    e.g. png, svg or pdf), using the non-interactive Agg backend, so no display is needed.
+    Otherwise, the plot is shown in a window.
     Make sure you have a suitable matplotlib backend available and optionally configured
     (is done in the rcparams).
     """
     import matplotlib
-    matplotlib.use("Qt5Agg")
+    matplotlib.use("Agg" if output else "Qt5Agg")
     from matplotlib import pyplot
-    from matplotlib.dates import DateFormatter, WeekdayLocator, DayLocator, HourLocator, MinuteLocator
+    from matplotlib.dates import DateFormatter, MonthLocator, WeekdayLocator, DayLocator, HourLocator, MinuteLocator
+    from matplotlib.dates import date2num
     from matplotlib.dates import MO #, TU, WE, TH, FR, SA, SU
 
-    #def timelines(y, xstart, xstop, color='b'):
-    #    """Plot timelines at y from xstart to xstop with given color."""
-    #    pyplot.hlines(y, xstart, xstop, color, lw=4)
-    #    pyplot.vlines(xstart, y+0.03, y-0.03, color, lw=2)
-    #    pyplot.vlines(xstop, y+0.03, y-0.03, color, lw=2)
-
     labels = sorted(timespans_by_label.keys())
     colors = list("rgbcmyk")
     colors = colors*int(len(labels)/len(colors)+1)    # Make sure we have more colors than labels
-    for i, label in enumerate(labels):
-        entries = timespans_by_label[label]
-        for entry in entries:
-            pyplot.hlines(i+1, entry["start"], entry["stop"], colors[i], lw=12)
-    #Setup the plot
-    ax = pyplot.gca()
-    pyplot.yticks(range(1, len(labels)+1), labels)
 
     min_startdate = min(entry["start"]
                         for entries in timespans_by_label.values() for entry in entries)
     max_stopdate = max(entry["stop"]
                        for entries in timespans_by_label.values() for entry in entries)
+    timespan = max_stopdate - min_startdate
+
+    fig = pyplot.figure(dpi=dpi)
+    ax = pyplot.gca()
+    # The x-axis shows 1.2 times the timespan (see graph limits below):
+    pixel = 1.2*timespan / (fig.get_size_inches()[0]*dpi) if decimate else timedelta(0)
+    nspans = 0
+    for i, label in enumerate(labels):
+        spans = decimate_timespans(sorted(timespans_by_label[label], key=itemgetter("start")), pixel)
+        nspans += len(spans)
+        if not spans:
+            continue
+        starts = date2num([start for start, _ in spans])
+        stops = date2num([stop for _, stop in spans])
+        ax.broken_barh(list(zip(starts, stops - starts)), (i+1-0.3, 0.6), facecolors=colors[i], edgecolors="none")
+    logger.debug("Plotting %s timespans (after merging timespans closer than %s).", nspans, pixel)
+    #Setup the plot
+    pyplot.yticks(range(1, len(labels)+1), labels)
 
     timespan = max_stopdate - min_startdate
     ax.xaxis_date()
-    if timespan > timedelta(7):
+    if timespan > timedelta(200):
+        # Daily ticks would be too many (and slow to draw):
+        ax.xaxis.set_major_formatter(DateFormatter("%Y-%m"))
+        months_per_tick = next((months for months in (1, 2, 3, 6) if months >= timespan.days / 365), 12)
+        ax.xaxis.set_major_locator(MonthLocator(bymonth=range(1, 13, months_per_tick)))
+        ax.xaxis.set_minor_locator(WeekdayLocator(byweekday=MO))  # tick every monday
+    elif timespan > timedelta(7):
         # If timespan is larger than 7 days:
         ax.xaxis.set_major_formatter(DateFormatter("%y/%m/%d %H"))
         ax.xaxis.set_major_locator(WeekdayLocator(byweekday=MO))  # tick every monday
@@ -299,14 +2201,94 @@ def plot_timeline(timespans_by_label):
     pyplot.ylim(0, len(labels)+1)
 
     pyplot.xlabel('Time')
+    pyplot.tight_layout()
+    if output:
+        pyplot.savefig(output, dpi=dpi)
+        pyplot.close(fig)
+        return
     #pyplot.interactive(True)
     pyplot.ioff()
     #pyplot.ion()
     print("\n\nShowing plot...")
-    pyplot.tight_layout()
     pyplot.show()
 
 
+stats_formats = ("table", "json")
+
+
+class PipelineStats(object):
+    """
+    Records wall time, number of events, bytes processed, unmatched lines and memory use for each
+    stage of the pipeline in main. Each stage is recorded as a dict with keys
+        stage, seconds, events, bytes, unmatched, peak_kb, maxrss_kb
+    where events, bytes and unmatched are set by the caller (None if not applicable).
+    If trace_memory is True, peak_kb is the peak memory allocated by python during the stage
+    (using tracemalloc, which makes the stages considerably slower). maxrss_kb is the peak
+    resident set size of the process at the end of the stage (if available on the platform).
+    """
+
+    def __init__(self, trace_memory=False):
+        self.stages = []
+        self.trace_memory = trace_memory
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Context manager recording a stage; yields the stage dict, so the caller can add counts. """
+        record = {"stage": name, "seconds": None, "events": None, "bytes": None, "unmatched": None,
+                  "peak_kb": None, "maxrss_kb": None}
+        if self.trace_memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            if self.trace_memory:
+                record["peak_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+            try:
+                import resource
+                # Note: ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+                record["maxrss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                if sys.platform == "darwin":
+                    record["maxrss_kb"] //= 1024
+            except ImportError:
+                pass
+            self.stages.append(record)
+
+    def format(self, fmt="table"):
+        """ Format the recorded stages as table or json string. """
+        if fmt == "json":
+            return json.dumps(self.stages, indent=2) + "\n"
+        if fmt != "table":
+            raise ValueError("Unknown stats format %r, must be one of %s." % (fmt, ", ".join(stats_formats)))
+        def fmt_int(value):
+            """ Format a count, or '-' if it is not applicable. """
+            return "-" if value is None else "%d" % value
+        width = max([len(record["stage"]) for record in self.stages] + [5])
+        lines = ["%-*s %9s %10s %12s %10s %10s %10s" % (width, "Stage", "Seconds", "Events", "Bytes",
+                                                        "Unmatched", "Peak kB", "MaxRSS kB")]
+        lines += ["%-*s %9.3f %10s %12s %10s %10s %10s" % (
+            width, record["stage"], record["seconds"], fmt_int(record["events"]), fmt_int(record["bytes"]),
+            fmt_int(record["unmatched"]), fmt_int(record["peak_kb"]), fmt_int(record["maxrss_kb"]))
+                  for record in self.stages]
+        lines.append("%-*s %9.3f" % (width, "Total", sum(record["seconds"] for record in self.stages)))
+        return "\n".join(lines) + "\n"
+
+
+def count_file_lines(filename, chunksize=1 << 20):
+    """ Return (number of bytes, number of lines) in filename. A final line without newline is counted. """
+    nbytes = nlines = 0
+    chunk = b""
+    with open(filename, "rb") as filep:
+        for chunk in iter(lambda: filep.read(chunksize), b""):
+            nbytes += len(chunk)
+            nlines += chunk.count(b"\n")
+    return nbytes, nlines + (chunk[-1:] not in (b"", b"\n"))
+
+
 def parse_args(argv=None):
     """
     Parse command line arguments.
@@ -315,10 +2297,20 @@ def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="Cadnano apply sequence script.")
     parser.add_argument("--verbose", "-v", action="count", help="Increase verbosity.")
     parser.add_argument("--testing", action="store_true", help="Run app in simple test mode.")
-    #parser.add_argument("--profile", "-p", action="store_true", help="Profile app execution.")
-    #parser.add_argument("--print-profile", "-P", action="store_true", help="Print profiling statistics.")
-    #parser.add_argument("--profile-outputfn", default="scaffold_rotation.profile",
-                        #help="Save profiling statistics to this file.")
+    # Note: -p is used for --timelineplot.
+    parser.add_argument("--profile", action="store_true", help="Profile app execution (using cProfile).")
+    parser.add_argument("--print-profile", "-P", action="store_true",
+                        help="Print profiling statistics (implies --profile).")
+    parser.add_argument("--profile-outputfn", help="Save profiling statistics to this file (implies --profile). "
+                        "The file can be loaded with pstats or e.g. snakeviz.")
+    parser.add_argument("--stats", action="store_true",
+                        help="Print wall time, events, bytes, unmatched lines and memory use for each pipeline stage.")
+    parser.add_argument("--stats-format", choices=stats_formats, default="table",
+                        help="Output format for --stats (default: table).")
+    parser.add_argument("--stats-output", help="Write the --stats output to this file instead of stderr.")
+    parser.add_argument("--stats-memory", action="store_true",
+                        help="Include peak python memory allocation for each stage in --stats (using tracemalloc). "
+                        "Note: This makes all stages considerably slower.")
 
     #parser.add_argument("--seqfile", "-s", nargs=1, required=True, help="File containing the sequences")
     #parser.add_argument("seqfile", help="File containing the sequences")
@@ -327,16 +2319,69 @@ def parse_args(argv=None):
 
     # NOTE: Windows does not support wildcard expansion in the default command line prompt!
 
+    parser.add_argument("--bulk-parse", action="store_true",
+                        help="Parse each file as a whole (memory-mapped) instead of line-by-line. "
+                        "This is faster for large files; the result is the same. Note: The parse cache "
+                        "(used unless --no-cache is given) always parses this way, so this option only "
+                        "has an effect together with --no-cache.")
+
+    parser.add_argument("--workers", "-j", type=int,
+                        help="Parse files in parallel using this many worker processes.")
+
+    parser.add_argument("--cache-dir", help="Directory for caching parsed files. Files that have only "
+                        "been appended to since the last run are parsed incrementally. "
+                        "Default: $XDG_CACHE_HOME/timetracker or ~/.cache/timetracker.")
+    parser.add_argument("--no-cache", action="store_true", help="Do not use the parse cache.")
+    parser.add_argument("--rebuild-cache", action="store_true",
+                        help="Re-parse all files and re-create their cache files.")
+
+    parser.add_argument("--report", choices=report_groupings,
+                        help="Print a report with total time and number of timespans, grouped by label, tag, "
+                        "calendar day, week or month, or hour of the week.")
+    parser.add_argument("--report-format", choices=report_formats, default="table",
+                        help="Output format for --report (default: table).")
+    parser.add_argument("--concurrency-report", action="store_true",
+                        help="Print total, exclusive and shared time for each label, time with each number of "
+                        "concurrently running labels, and the longest overlaps between labels "
+                        "(mostly useful with --no-auto-stop-on-start). Uses --report-format.")
+    parser.add_argument("--report-output", help="Write the --report and --concurrency-report output to this file "
+                        "instead of stdout.")
+
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running, parse lines as they are appended to the files, and answer queries "
+                        "for current totals and timespans over http (see --watch-port).")
+    parser.add_argument("--watch-interval", type=float, default=1.0,
+                        help="Seconds between checking the files for new lines with --watch (default: 1).")
+    parser.add_argument("--watch-host", default="127.0.0.1", help="Address of the --watch query server.")
+    parser.add_argument("--watch-port", type=int, default=8765,
+                        help="Port of the --watch query server (default: 8765). Queries: /totals, /timespans and "
+                        "/status, with parameters e.g. ?period=today or ?window_start=2015-06-01T00:00.")
+
+    parser.add_argument("--export-events", metavar="FILE",
+                        help="Export all parsed lines (events) to this file, e.g. for loading into a database.")
+    parser.add_argument("--export-timespans", metavar="FILE",
+                        help="Export the timespans (after filtering) to this file.")
+    parser.add_argument("--export-format", choices=export_formats,
+                        help="Format for --export-events/--export-timespans: jsonl (JSON Lines), csv, parquet "
+                        "(requires pyarrow), npz (numpy), or columnar (parquet if available, otherwise npz). "
+                        "Default: Determined by the file extension.")
+
     parser.add_argument("--timelineplot", "-p", action="store_true", help="Produce a time-line plot.")
     parser.add_argument("--no-timelineplot", action="store_false", dest="timelineplot",
                         help="Do not produce a time-line plot.")
+    parser.add_argument("--plot-output", help="Save the time-line plot to this file (e.g. png, svg or pdf) "
+                        "instead of showing it in a window. Does not require a display.")
+    parser.add_argument("--plot-dpi", type=int, default=100, help="Resolution of the time-line plot.")
+    parser.add_argument("--no-plot-decimation", action="store_false", dest="plot_decimation",
+                        help="Do not merge timespans that are closer than a pixel in the time-line plot.")
 
     ## DONE: auto_stop_on_start and discart_redundant_stops flags
     parser.add_argument("--no-auto-stop-on-start", "-A", action="store_false", dest="auto_stop_on_start")
     parser.add_argument("--auto-stop-on-start", "-a", action="store_true",
                         help="Automatically stop running activities when a new activity is started.")
 
-    parser.add_argument("--no-discart-redundant-stops", "-D", action="store_false", dest="discart_redundant_stops")
+    parser.add_argument("--no-discart-redundant-stops", "-D", action="store_false", dest="discart_redundant_stops",
+                        default=False)
     parser.add_argument("--discart-redundant-stops", "-d", action="store_true",
                         help="Discart redundant stop entries.")
 
@@ -354,6 +2399,13 @@ def parse_args(argv=None):
     parser.add_argument("--end-after", nargs=2, help="Only consider entries with enddate after this.")
     parser.add_argument("--end-before", nargs=2, help="Only consider entries with enddate before this.")
 
+    parser.add_argument("--window-start", nargs=2,
+                        help="Only consider entries overlapping the time window starting at this date/time "
+                        "(yyyy-mm-dd HH:MM). Entries are clipped to the window.")
+    parser.add_argument("--window-end", nargs=2,
+                        help="Only consider entries overlapping the time window ending at this date/time "
+                        "(yyyy-mm-dd HH:MM). Entries are clipped to the window.")
+
     parser.add_argument("--today", action="store_true", help="Only consider entries with startdate during today. "
                         "(Note that date short-hands are mutually exclusive at the moment.)")
     parser.add_argument("--yesterday", action="store_true",
@@ -364,6 +2416,12 @@ def parse_args(argv=None):
     parser.add_argument("--labels", "-l", nargs="+", help="Only include these labels.")
     parser.add_argument("--exclude-labels", nargs="+", help="Exclude these labels.")
 
+    parser.add_argument("--tags", "-t", nargs="+",
+                        help="Only include timespans with any of these tags (e.g. work, without the '#').")
+    parser.add_argument("--match-all-tags", action="store_true",
+                        help="Only include timespans with all of the --tags (instead of any of them).")
+    parser.add_argument("--exclude-tags", nargs="+", help="Exclude timespans with any of these tags.")
+
     parser.add_argument("--discart-empty-labels", action="store_true",
                         help="Discart labels with zero timespans (can happen after filtering).")
 
@@ -396,8 +2454,9 @@ def process_args(argns=None, argv=None):
 
     # Load config with parameters:
     if args.get("config"):
+        import yaml
         with open(args["config"]) as fp:
-            cfg = yaml.load(fp)
+            cfg = yaml.safe_load(fp)
         args.update(cfg)
 
     # On windows, we have to expand glob patterns manually:
@@ -416,7 +2475,12 @@ def process_args(argns=None, argv=None):
         args["start_after"] = datetime(now.year, now.month, now.day) - timedelta(6)
 
 
-    time_criteria = ("start_before", "start_after", "end_before", "end_after")
+    # Check export formats before parsing (raises ValueError if the format cannot be determined):
+    for key in ("export_events", "export_timespans"):
+        if args.get(key):
+            resolve_export_format(args[key], args.get("export_format"))
+
+    time_criteria = ("start_before", "start_after", "end_before", "end_after", "window_start", "window_end")
     for criteria in time_criteria:
         if (not args.get(criteria)) or isinstance(args[criteria], datetime):
             continue
@@ -429,17 +2493,87 @@ def process_args(argns=None, argv=None):
 
 def main(argv=None):
     """ Main driver """
-    logging.basicConfig(level=10)
     args = process_args(None, argv)
-    lines = parse_files(args['files'])
-    lines_by_label = get_lines_by_label(lines)
-    timespans_by_label = find_timespans_by_label(lines_by_label)
-    timespans_by_label = filter_main(timespans_by_label, args)
-    if args["timelineplot"]:
-        plot_timeline(timespans_by_label)
+    # Default log level is WARNING, -v gives INFO and -vv gives DEBUG:
+    logging.basicConfig(level=max(logging.DEBUG, logging.WARNING - 10*(args["verbose"] or 0)))
+    if args["profile"] or args["print_profile"] or args["profile_outputfn"]:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.runcall(watch if args["watch"] else run_pipeline, args)
+        if args["profile_outputfn"]:
+            profiler.dump_stats(args["profile_outputfn"])
+            print("Profiling statistics saved to", args["profile_outputfn"], file=sys.stderr)
+        if args["print_profile"] or not args["profile_outputfn"]:
+            import pstats
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(30)
+    elif args["watch"]:
+        watch(args)
+    else:
+        run_pipeline(args)
+
+
+def run_pipeline(args):
+    """ Run parsing, pairing, filtering, reporting and plotting as specified by args (see process_args). """
+    stats = PipelineStats(trace_memory=args.get("stats_memory"))
+    cache_dir = None if args["no_cache"] else (args["cache_dir"] or default_cache_dir())
+    with stats.stage("parse_files") as parse_stage:
+        lines = parse_files(args['files'], bulk=args["bulk_parse"], workers=args["workers"],
+                            cache_dir=cache_dir, rebuild_cache=args["rebuild_cache"])
+        parse_stage["events"] = len(lines)
+    if args.get("stats"):
+        # Counted separately (not included in the parse_files time), since it requires re-reading the files:
+        counts = [count_file_lines(filename) for filename in args["files"]]
+        parse_stage["bytes"] = sum(nbytes for nbytes, _ in counts)
+        parse_stage["unmatched"] = sum(nlines for _, nlines in counts) - len(lines)
+    if args["export_events"]:
+        with stats.stage("export_events") as stage:
+            stage["events"] = export_events(lines, args["export_events"], args["export_format"])
+    with stats.stage("get_lines_by_label") as stage:
+        lines_by_label = get_lines_by_label(lines, auto_stop_on_start=args["auto_stop_on_start"],
+                                            discart_redundant_stops=args["discart_redundant_stops"],
+                                            presorted=bool(args["workers"] and args["workers"] > 1))
+        stage["events"] = sum(len(label_lines) for label_lines in lines_by_label.values())
+    with stats.stage("find_timespans_by_label") as stage:
+        timespans_by_label = find_timespans_by_label(lines_by_label)
+        stage["events"] = sum(len(entries) for entries in timespans_by_label.values())
+    with stats.stage("filter_main") as stage:
+        timespans_by_label = filter_main(timespans_by_label, args)
+        stage["events"] = sum(len(entries) for entries in timespans_by_label.values())
+    if args["export_timespans"]:
+        with stats.stage("export_timespans") as stage:
+            stage["events"] = export_timespans(timespans_by_label, args["export_timespans"], args["export_format"])
+    reports = []
+    if args["report"]:
+        with stats.stage("report") as stage:
+            rows = report_totals(timespans_by_label, args["report"])
+            reports.append(format_report(rows, args["report_format"]))
+            stage["events"] = len(rows)
+    if args["concurrency_report"]:
+        with stats.stage("concurrency_report") as stage:
+            result = sweep_timespans(timespans_by_label)
+            reports.append(format_concurrency_report(result, args["report_format"]))
+            stage["events"] = len(result["overlaps"])
+    if reports and args["report_output"]:
+        with open(args["report_output"], "w") as filep:
+            filep.write("".join(reports))
+    elif reports:
+        print("".join(reports), end="")
+    if args["timelineplot"] or args["plot_output"]:
+        with stats.stage("plot_timeline") as stage:
+            plot_timeline(timespans_by_label, output=args["plot_output"], dpi=args["plot_dpi"],
+                          decimate=args["plot_decimation"])
+            stage["events"] = sum(len(entries) for entries in timespans_by_label.values())
+    if args.get("stats"):
+        if args["stats_output"]:
+            with open(args["stats_output"], "w") as filep:
+                filep.write(stats.format(args["stats_format"]))
+        else:
+            print(stats.format(args["stats_format"]), end="", file=sys.stderr)
+    return timespans_by_label
 
 def test1():
     """ Primitive test. """
+    import yaml
     testfile = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
                             "tests", "testdata", "TimeTracker.txt")
     args = {"files": [testfile],
@@ -476,9 +2610,990 @@ def test2():
     main(argv)
 
 
+def test_timespans_regression(ntrials=200, seed=0):
+    """
+    Compare find_timespans_by_label against the original quadratic implementation on randomized input.
+    Both timespans and the logged warnings must be identical.
+    """
+    import random
+    rng = random.Random(seed)
+
+    class ListHandler(logging.Handler):
+        """ Collect log messages in a list. """
+        def __init__(self):
+            super().__init__(level=logging.WARNING)
+            self.messages = []
+        def emit(self, record):
+            self.messages.append(record.getMessage())
+
+    handler = ListHandler()
+    logger.addHandler(handler)
+    ntrimmed = 0
+    try:
+        for trial in range(ntrials):
+            labels = ["activity %s" % i for i in range(rng.randint(1, 6))]
+            t0 = datetime(2015, 6, 1, 8, 0)
+            lines = [{"datetime": t0 + timedelta(minutes=rng.randint(0, 600)),
+                      "action": rng.choice(("start", "start", "stop", "pause")),
+                      "label": rng.choice(labels).title(), "tags": "", "comment": None,
+                      "filename": "random.txt", "lineno": lineno}
+                     for lineno in range(rng.randint(0, 60))]
+            lines_by_label = get_lines_by_label(lines, auto_stop_on_start=rng.random() < 0.5)
+            # The original implementation re-uses a stale (or unbound) next_stop variable when a label has
+            # more than one start after its last stop, so for such labels only the lines up to the first of
+            # those starts are compared. The other starts are checked below to give open-ended entries:
+            compared, dropped = {}, {}
+            for label, label_lines in lines_by_label.items():
+                actions = [line["action"] for line in label_lines]
+                last_stop = max((i for i, action in enumerate(actions) if action == "stop"), default=-1)
+                trailing_starts = [i for i in range(last_stop + 1, len(actions)) if actions[i] == "start"]
+                cut = trailing_starts[0] + 1 if len(trailing_starts) > 1 else len(label_lines)
+                compared[label] = label_lines[:cut]
+                dropped[label] = [line for line in label_lines[cut:] if line["action"] == "start"]
+                ntrimmed += bool(dropped[label])
+            now = datetime.now()
+            handler.messages = []
+            expected = _find_timespans_by_label_quadratic(compared)
+            expected_messages, handler.messages = handler.messages, []
+            found = find_timespans_by_label(compared, now=now)
+            assert handler.messages == expected_messages, (trial, handler.messages, expected_messages)
+            assert found.keys() == expected.keys(), (trial, found.keys(), expected.keys())
+            for label, entries in expected.items():
+                assert len(found[label]) == len(entries)
+                for entry, expected_entry in zip(found[label], entries):
+                    if expected_entry["stop"] >= now:
+                        # Open-ended entry: the original implementation calls datetime.now() itself.
+                        expected_entry = dict(expected_entry, stop=now, timespan=now-expected_entry["start"])
+                    # The original implementation does not carry the tags and comment of the start line:
+                    entry = {key: value for key, value in entry.items() if key not in ("tags", "comment")}
+                    assert entry == expected_entry, (trial, entry, expected_entry)
+            found_all = find_timespans_by_label(lines_by_label, now=now)
+            assert found_all.keys() == found.keys(), (trial, found_all.keys(), found.keys())
+            for label, entries in found_all.items():
+                assert [(entry["start"], entry["stop"]) for entry in entries] == \
+                    [(entry["start"], entry["stop"]) for entry in found[label]] \
+                    + [(line["datetime"], now) for line in dropped[label]], (trial, label)
+    finally:
+        logger.removeHandler(handler)
+    print("find_timespans_by_label matches original implementation in %s random trials "
+          "(%s labels with repeated starts after the last stop were only partly compared)." % (ntrials, ntrimmed))
+
+
+def benchmark_lines_by_label(nlines=20000, label_counts=(10, 100, 1000, 10000), seed=0):
+    """
+    Time get_lines_by_label against the original label-scanning loop for an increasing number of labels.
+    The time per line should be constant for get_lines_by_label, but grow with the number of labels
+    for the original loop.
+    """
+    import random
+    rng = random.Random(seed)
+    t0 = datetime(2015, 6, 1, 8, 0)
+    print("%8s %8s %14s %14s %8s" % ("labels", "lines", "scan us/line", "set us/line", "speedup"))
+    for nlabels in label_counts:
+        labels = ["Activity %s" % i for i in range(nlabels)]
+        lines = [{"datetime": t0 + timedelta(minutes=lineno), "action": rng.choice(("start", "stop")),
+                  "label": rng.choice(labels), "filename": "random.txt", "lineno": lineno}
+                 for lineno in range(nlines)]
+        timings = []
+        for func in (_get_lines_by_label_scan, get_lines_by_label):
+            copies = [dict(line) for line in lines]  # get_lines_by_label pops keys from the line dicts.
+            start = time.perf_counter()
+            func(copies, auto_stop_on_start=True)
+            timings.append(time.perf_counter() - start)
+        print("%8s %8s %14.2f %14.2f %7.1fx" % (nlabels, nlines, timings[0]/nlines*1e6, timings[1]/nlines*1e6,
+                                                 timings[0]/timings[1]))
+
+
+def test_parse_timestamp():
+    """ Check that parse_timestamp gives the same result (or ValueError) as strptime, also for malformed input. """
+    datestrs = ["2015-06-01 08.05", "0529-07-31 -0.01", "0529-07-31 +1.01", "2015-06-01 08.-5", "2015-06-01 08.+5",
+                "2015-06-01  8.05", "2015-06-01 08. 5", "2015-06-01 24.00", "2015-06-01 08.60", "2015-02-30 08.05",
+                "2015-6-1 8.5", "2015-06-01 8.05", "2015-06-01 08:05", "2015-06-01 0_8.05", "2015-06-01 08.0\u00b2",
+                "+015-06-01 08.05", "2015-06-01T08.05", "2015-06-01 08.05 "]
+    for cached in (False, True):
+        if not cached:
+            _date_cache.clear()
+        for datestr in datestrs:
+            try:
+                expected = datetime.strptime(datestr, datestrptime)
+            except ValueError:
+                expected = ValueError
+            try:
+                found = parse_timestamp(datestr)
+            except ValueError:
+                found = ValueError
+            assert found == expected, (datestr, cached, found, expected)
+    print("parse_timestamp gives the same result as strptime.")
+
+
+def benchmark_timestamp_parsing(nlines=1000000, ndays=1000):
+    """
+    Compare parse_timestamp with datetime.strptime on nlines timestamps spread over ndays days.
+    """
+    t0 = datetime(2015, 6, 1, 8, 0)
+    datestrs = [(t0 + timedelta(minutes=i*ndays*1440//nlines)).strftime(datestrptime) for i in range(nlines)]
+    _date_cache.clear()
+    timings = []
+    for func in (lambda datestr: datetime.strptime(datestr, datestrptime), parse_timestamp):
+        start = time.perf_counter()
+        parsed = [func(datestr) for datestr in datestrs]
+        timings.append(time.perf_counter() - start)
+    assert parsed[::1000] == [datetime.strptime(datestr, datestrptime) for datestr in datestrs[::1000]]
+    print("Parsing %s timestamps: strptime %.2f s, parse_timestamp %.2f s (%.1fx faster)."
+          % (nlines, timings[0], timings[1], timings[0]/timings[1]))
+
+
+def generate_timetracker_files(directory, nevents, nfiles=1, nlabels=50, ntags=5, tag_rate=0.2,
+                                comment_rate=0.1, missing_start_rate=0.01, missing_stop_rate=0.02,
+                                malformed_rate=0.01, start_time=datetime(2015, 6, 1, 8, 0), seed=0):
+    """
+    Write deterministic, realistic timetracker files to directory and return the list of filenames.
+    Activities are started and stopped one after another (start, stop, pause, next start, ...) with a
+    random label of nlabels, lasting 5 minutes to 2 hours, with pauses of up to an hour.
+    The activities are distributed randomly over nfiles files (e.g. one file per computer).
+
+    Args:
+        nevents: The total number of lines written (including malformed lines).
+        ntags, tag_rate: Share of lines with one or two tags (of ntags distinct tags).
+        comment_rate: Share of lines with a comment.
+        missing_start_rate, missing_stop_rate: Share of activities where the start/stop line is left out.
+        malformed_rate: Share of lines that are malformed (not matching the line regex or with invalid timestamp).
+        seed: Seed for the random number generator. The same arguments always give the same files.
+    """
+    import random
+    rng = random.Random(seed)
+    labels = ["activity %s" % i for i in range(nlabels)]
+    tags = ["tag%s" % i for i in range(ntags)]
+    malformed = ("%s start", "%s invalid line", "started %s", "2015-02-30 08.08 start %s", "2015-06-01 25.00 stop %s")
+    filenames = [os.path.join(directory, "TimeTracker-%s.txt" % i) for i in range(nfiles)]
+    filepointers = [open(filename, "w") for filename in filenames]
+    t = datetime_to_epoch_minutes(start_time)
+    try:
+        written = 0
+        while written < nevents:
+            label = rng.choice(labels)
+            filep = rng.choice(filepointers)
+            duration = rng.randint(5, 120)
+            for action, missing_rate in (("start", missing_start_rate), ("stop", missing_stop_rate)):
+                if written == nevents:
+                    break
+                if rng.random() < missing_rate:
+                    continue
+                dt = epoch_minutes_to_datetime(t + (duration if action == "stop" else 0))
+                if rng.random() < malformed_rate:
+                    line = rng.choice(malformed) % label
+                else:
+                    line = "%04d-%02d-%02d %02d.%02d %s %s" % (dt.year, dt.month, dt.day, dt.hour, dt.minute,
+                                                              action, label)
+                    if tags and rng.random() < tag_rate:
+                        line += " #" + " #".join(rng.sample(tags, min(rng.randint(1, 2), ntags)))
+                    if rng.random() < comment_rate:
+                        line += ", comment %s" % rng.randint(0, 1000)
+                filep.write(line + "\n")
+                written += 1
+            t += duration + rng.randint(0, 60)
+    finally:
+        for filep in filepointers:
+            filep.close()
+    return filenames
+
+
+def _random_timespans(rng, nspans, labels=("A", "B", "C"), t0=datetime(2015, 6, 1, 8, 0), max_start=600,
+                      max_durations=(0, 60, 600), tags=("",)):
+    """
+    Return timespans_by_label with nspans random timespans (sorted by start for each label), for tests.
+    Each timespan starts 0 to max_start minutes after t0 and lasts 0 to (a random one of) max_durations
+    minutes, with a random label of labels and random tags of tags (e.g. ("", "#work", ("work", "fun"))).
+    """
+    timespans_by_label = defaultdict(list)
+    for _ in range(nspans):
+        label = rng.choice(labels)
+        start = t0 + timedelta(minutes=rng.randint(0, max_start))
+        stop = start + timedelta(minutes=rng.randint(0, rng.choice(max_durations)))
+        timespans_by_label[label].append({"label": label, "start": start, "stop": stop, "timespan": stop-start,
+                                          "tags": rng.choice(tags), "comment": None})
+    for entries in timespans_by_label.values():
+        entries.sort(key=itemgetter("start"))
+    return timespans_by_label
+
+
+def test_bulk_parse():
+    """ Check that parse_file_bulk gives the same result as parse_file, also for lines with odd whitespace. """
+    import tempfile
+    tricky = ["2015-06-01 08.00 start foo", "  2015-06-01 08.01 stop foo  ", "2015-06-01 08.02 start bar #work \t",
+              "2015-06-01 08.03 START bar baz  #work#fun, comment with # and , \t ", "", "   ", "not a line",
+              "2015-06-01 08.04 start    ", "2015-06-01 08.05 start   #tag", "2015-06-01 08.06 stop foo, ",
+              "2015-06-01 08.07 stop foo,  x, y ", "2015-02-30 08.08 start malformed date", "2015-6-1 8.09 start x",
+              "2015-06-01 08.10 start æøå #tæg, kommentar", "2015-06-01 08.11 stop \tFoo\t",
+              "2015-06-01 25.00 start bad hour", "2015-06-01 08.12 start foo,  ,  x",
+              # Whitespace that is only whitespace in str (parse_file), not in bytes (parse_file_bulk):
+              "2015-06-01\xa008.13\xa0start\xa0nbsp", "2015-06-01 08.14\u2003start em\u2003space #tag\u2003",
+              "\x1c2015-06-01 08.15 start separator\x1f", "2015-06-01 08.16 start x\x85"]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for i, content in enumerate(("\n".join(tricky), "\n".join(tricky) + "\n", "\r\n".join(tricky), "",
+                                     "\r".join(tricky), "\n".join(tricky + ["2015-06-01 08.17 start a\rstop b"]))):
+            filename = os.path.join(tmpdir, "tricky%s.txt" % i)
+            with open(filename, "w", encoding="utf-8", newline="") as filep:
+                filep.write(content)
+            expected = parse_file(filename)
+            assert parse_file_bulk(filename) == expected, (content, parse_file_bulk(filename), expected)
+        filename, = generate_timetracker_files(tmpdir, 10000, malformed_rate=0.05)
+        assert parse_file_bulk(filename) == parse_file(filename)
+    print("parse_file_bulk gives the same result as parse_file.")
+
+
+def test_parallel_parse(nfiles=8, workers=4):
+    """ Check that parsing files in parallel gives the same result as the serial path. """
+    import pickle
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filenames = generate_timetracker_files(tmpdir, nfiles*2000, nfiles=nfiles)
+        # Add a file that is not sorted, and a file with lines at the same time as lines in another file:
+        with open(filenames[0], "a") as filep:
+            filep.write("2015-06-01 08.00 start unsorted\n2015-06-01 08.00 stop unsorted\n")
+        with open(filenames[1]) as infile, open(filenames[2], "a") as outfile:
+            outfile.write(infile.read())
+        now = datetime.now()
+        for bulk in (False, True):
+            expected = find_timespans_by_label(get_lines_by_label(parse_files(filenames, bulk=bulk)), now=now)
+            lines = parse_files(filenames, bulk=bulk, workers=workers)
+            assert lines == sorted(lines, key=line_sort_key)
+            found = find_timespans_by_label(get_lines_by_label(lines, presorted=True), now=now)
+            assert found == expected
+            # The worker results and their merge (checked here also if there is only one CPU, so the files
+            # are parsed serially). The first file is given twice:
+            runs = []
+            for filename in filenames:
+                columns = pickle.loads(pickle.dumps(_parse_file_columns(filename, bulk)))
+                assert columns_to_lines(columns) == _parse_file_sorted(filename, bulk)
+                runs.append(columns)
+            # (get_lines_by_label modifies the line dicts, so they are parsed again to compare with):
+            assert _merge_column_runs(iter(runs)) == parse_files(filenames, bulk=bulk, workers=workers)
+            expected = parse_files(filenames + filenames[:1], bulk=bulk)
+            expected.sort(key=line_sort_key)
+            assert _merge_column_runs(runs + runs[:1]) == expected
+    print("Parsing %s files with %s workers gives the same result as parsing serially." % (nfiles, workers))
+
+
+def test_parse_cache():
+    """ Check that parse_file_cached gives the same result as parse_file, also after the file is changed. """
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache_dir = os.path.join(tmpdir, "cache")
+        filename = os.path.join(tmpdir, "TimeTracker-0.txt")
+        def check(description):
+            """ Check cached result (twice, to also check reading the cache file just written). """
+            expected = parse_file(filename)
+            assert parse_file_cached(filename, cache_dir) == expected, description
+            assert parse_file_cached(filename, cache_dir) == expected, description
+        open(filename, "w").close()
+        check("empty file")
+        generate_timetracker_files(tmpdir, 1000)
+        check("new file")
+        with open(filename, "a") as filep:
+            filep.write("2016-01-01 08.00 start appended line\n2016-01-01 09.00 stop appended")
+        check("appended lines, last line without newline")
+        with open(filename, "a") as filep:
+            filep.write(" line\n")
+        check("completed last line")
+        with open(filename, "r+") as filep:
+            filep.write("2015-01-01 07.00 start changed first line")
+        check("changed file")
+        stat = os.stat(filename)
+        with open(filename, "rb+") as filep:
+            data = filep.read()
+            filep.seek(data.index(b"appended line"))
+            filep.write(b"edited")
+        os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        check("edited in place with unchanged size and modification time")
+        with open(filename, "a", newline="") as filep:
+            filep.write("2016-01-02 08.00 start bare\rcarriage return\r\n2016-01-02 09.00 start \xa0nbsp\n")
+        check("appended lines with bare carriage return and non-ascii whitespace")
+        with open(filename, "a") as filep:
+            filep.write("2016-01-03 08.00 start after bare carriage return\n")
+        check("appended line after bare carriage return")
+        with open(filename, "w") as filep:
+            filep.write("2015-01-01 07.00 start truncated file\n")
+        check("truncated file")
+        assert parse_file_cached(filename, cache_dir, rebuild=True) == parse_file(filename)
+    print("parse_file_cached gives the same result as parse_file.")
+
+
+def test_interval_index(ntrials=200, seed=0):
+    """ Compare filter_timespans with a straightforward linear filter on randomized timespans. """
+    import random
+    rng = random.Random(seed)
+    t0 = datetime(2015, 6, 1, 8, 0)
+    def random_time():
+        """ Return random datetime. """
+        return t0 + timedelta(minutes=rng.randint(-60, 1500))
+    for _ in range(ntrials):
+        timespans_by_label = _random_timespans(rng, rng.randint(0, 90), t0=t0 - timedelta(minutes=60),
+                                               max_start=1560)
+        args = {criteria: random_time() for criteria in ("start_before", "start_after", "end_before", "end_after",
+                                                         "window_start", "window_end") if rng.random() < 0.3}
+        index = build_interval_index(timespans_by_label)
+        found = filter_timespans(timespans_by_label, args, index=index)
+        for label, entries in timespans_by_label.items():
+            expected = [clip_timespan(entry, args.get("window_start"), args.get("window_end")) for entry in entries
+                        if ("start_before" not in args or entry["start"] <= args["start_before"])
+                        and ("start_after" not in args or entry["start"] >= args["start_after"])
+                        and ("end_before" not in args or entry["stop"] <= args["end_before"])
+                        and ("end_after" not in args or entry["stop"] >= args["end_after"])
+                        and ("window_start" not in args or entry["stop"] > args["window_start"])
+                        and ("window_end" not in args or entry["start"] < args["window_end"])]
+            assert found[label] == expected, (args, found[label], expected)
+            for entry in found[label]:
+                assert entry["start"] >= args.get("window_start", entry["start"])
+                assert entry["stop"] <= args.get("window_end", entry["stop"])
+    print("filter_timespans gives the expected result in %s random trials." % ntrials)
+
+
+def test_report(ntrials=20, seed=0):
+    """ Compare report_totals with totals calculated minute-by-minute on random timespans. """
+    import random
+    rng = random.Random(seed)
+    for _ in range(ntrials):
+        timespans_by_label = _random_timespans(rng, rng.randint(1, 20), t0=datetime(2015, 12, 28, 8, 0),
+                                               max_start=60*24*60, max_durations=(0, 600, 60*24*3),
+                                               tags=("", "#work", "#work #fun", ("fun",)))
+        for group_by in report_groupings:
+            expected = defaultdict(int)
+            for entry in (entry for entries in timespans_by_label.values() for entry in entries):
+                if group_by in ("label", "tag"):
+                    groups = [entry["label"]] if group_by == "label" else split_tags(entry["tags"]) or ["(untagged)"]
+                    for group in groups:
+                        expected[group] += entry["timespan"] // timedelta(minutes=1)
+                    continue
+                minute = entry["start"]
+                while minute < entry["stop"]:
+                    group = {"day": minute.strftime("%Y-%m-%d"), "month": minute.strftime("%Y-%m"),
+                             "week": "%04d-W%02d" % minute.isocalendar()[:2],
+                             "hour-of-week": minute.strftime("%a %H:00")}[group_by]
+                    expected[group] += 1
+                    minute += timedelta(minutes=1)
+            found = {row["group"]: row["minutes"] for row in report_totals(timespans_by_label, group_by)
+                     if row["minutes"]}
+            assert found == {group: total for group, total in expected.items() if total}, \
+                (group_by, found, dict(expected))
+    print("report_totals gives the expected result in %s random trials." % ntrials)
+
+
+def test_tag_index(ntrials=200, seed=0):
+    """ Compare TagIndex/filter_tags queries with a scan of all timespans, and check tags through the pipeline. """
+    import random
+    import tempfile
+    rng = random.Random(seed)
+    tags = ("work", "fun", "clientx", "projecty")
+    tagsets = [tagset for n in range(4) for tagset in itertools.permutations(tags, n)]
+    timespans_by_label = _random_timespans(rng, 2000, labels=("A", "B", "C", "D"), max_start=2000*30,
+                                           max_durations=(20,), tags=tagsets)
+    tag_index = TagIndex(timespans_by_label)
+    for _ in range(ntrials):
+        args = {"tags": rng.sample(tags, rng.randint(0, 2)), "exclude_tags": rng.sample(tags, rng.randint(0, 1)),
+                "match_all_tags": rng.random() < 0.5}
+        match = all if args["match_all_tags"] else any
+        expected = {label: [entry for entry in entries
+                            if (not args["tags"] or match(tag in entry["tags"] for tag in args["tags"]))
+                            and not any(tag in entry["tags"] for tag in args["exclude_tags"])]
+                    for label, entries in timespans_by_label.items()}
+        if not args["tags"] and not args["exclude_tags"]:
+            expected = timespans_by_label
+        assert filter_tags(timespans_by_label, args, tag_index) == expected, args
+        assert filter_tags(timespans_by_label, args) == expected, args
+    # Tags that normalize to no tags are no tag filter, also with match_all_tags:
+    for match_all in (False, True):
+        assert tag_index.ids("#", match_all=match_all) == list(range(len(tag_index)))
+        assert filter_tags(timespans_by_label, {"tags": "# ", "match_all_tags": match_all}) == timespans_by_label
+        assert filter_main(timespans_by_label, {"tags": "#", "match_all_tags": match_all}) == timespans_by_label
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "TimeTracker.txt")
+        with open(filename, "w") as filep:
+            filep.write("2015-06-01 08.00 start Foo #ClientX #work, meeting\n2015-06-01 09.00 start Bar\n"
+                        "2015-06-01 09.30 start foo #work\n2015-06-01 10.00 stop foo\n")
+        args = process_args(None, [filename, "--tags", "clientx"])
+        timespans_by_label = find_timespans_by_label(get_lines_by_label(parse_files([filename])))
+        assert sorted(timespans_by_label) == ["Bar", "Foo"]
+        filtered = filter_main(timespans_by_label, args)
+        assert [(entry["tags"], entry["comment"]) for entry in filtered["Foo"]] == [(("clientx", "work"), "meeting")]
+        assert filtered["Bar"] == []
+        assert columns_to_timespans(timespans_to_columns(timespans_by_label)) == timespans_by_label
+    print("TagIndex gives the expected result in %s random trials." % ntrials)
+
+
+def test_sweep_timespans(ntrials=50, seed=0):
+    """ Compare sweep_timespans with times and overlaps calculated minute-by-minute/pairwise on random timespans. """
+    import random
+    rng = random.Random(seed)
+    t0 = datetime(2015, 6, 1, 8, 0)
+    for _ in range(ntrials):
+        timespans_by_label = _random_timespans(rng, rng.randint(0, 30), labels=("A", "B", "C", "D"), t0=t0,
+                                               max_durations=(0, 30, 300))
+        result = sweep_timespans(timespans_by_label)
+        running_by_minute = defaultdict(set)
+        for label, entries in timespans_by_label.items():
+            for entry in entries:
+                for minute in range((entry["stop"] - entry["start"]) // timedelta(minutes=1)):
+                    running_by_minute[entry["start"] + timedelta(minutes=minute)].add(label)
+        expected = defaultdict(lambda: {"total": timedelta(), "exclusive": timedelta(), "shared": timedelta()})
+        levels = defaultdict(timedelta)
+        minute = min(running_by_minute, default=None)
+        while running_by_minute and minute <= max(running_by_minute):
+            labels = running_by_minute.get(minute, ())
+            levels[len(labels)] += timedelta(minutes=1)
+            for label in labels:
+                expected[label]["total"] += timedelta(minutes=1)
+                expected[label]["exclusive" if len(labels) == 1 else "shared"] += timedelta(minutes=1)
+            minute += timedelta(minutes=1)
+        assert result["labels"] == expected, (result["labels"], dict(expected))
+        assert result["levels"] == levels, (result["levels"], dict(levels))
+        concurrency_levels = defaultdict(timedelta)
+        for (changed, level), (next_changed, _) in zip(result["concurrency"], result["concurrency"][1:]):
+            concurrency_levels[level] += next_changed - changed
+        assert concurrency_levels == levels, (dict(concurrency_levels), dict(levels))
+        entries = [entry for entries in timespans_by_label.values() for entry in entries]
+        noverlaps = sum(1 for i, a in enumerate(entries) for b in entries[i+1:] if a["label"] != b["label"]
+                        and max(a["start"], b["start"]) < min(a["stop"], b["stop"]))
+        assert len(result["overlaps"]) == noverlaps, (len(result["overlaps"]), noverlaps)
+        for entry, other, start, stop in result["overlaps"]:
+            assert start == max(entry["start"], other["start"]) and stop == min(entry["stop"], other["stop"])
+            assert entry["label"] != other["label"] and start < stop
+    # Many overlapping timespans of the same label (e.g. repeated starts with --no-auto-stop-on-start)
+    # give no pairs (and are not compared with each other, so this takes linear time):
+    entries = [{"label": "A", "start": t0 + timedelta(minutes=i), "stop": t0 + timedelta(days=30)}
+               for i in range(20000)]
+    start = time.perf_counter()
+    result = sweep_timespans({"A": entries, "B": [{"label": "B", "start": t0, "stop": t0 + timedelta(minutes=1)}]})
+    assert len(result["overlaps"]) == 1 and result["labels"]["A"]["total"] == timedelta(days=30)
+    print("sweep_timespans gives the expected result in %s random trials (%.2f s for 20000 overlapping "
+          "timespans of one label)." % (ntrials, time.perf_counter() - start))
+
+
+def test_export(nevents=20000, seed=0):
+    """ Check that exported events and timespans are loaded back unchanged, in all available formats. """
+    import tempfile
+    import tracemalloc
+    formats = ["jsonl", "csv", "npz"]
+    try:
+        import pyarrow     # pylint: disable=W0611
+        formats.append("parquet")
+    except ImportError:
+        print("pyarrow is not installed, skipping parquet export.")
+    now = datetime(2040, 1, 1)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filenames = generate_timetracker_files(tmpdir, nevents, nfiles=2, seed=seed)
+        lines = parse_files(filenames)
+        lines[0]["comment"] = 'a "quoted", comment with æøå'
+        timespans_by_label = find_timespans_by_label(get_lines_by_label([dict(line) for line in lines]), now=now)
+        for fmt in formats:
+            filename = os.path.join(tmpdir, "events." + fmt)
+            assert export_events(lines, filename) == len(lines)
+            assert load_events(filename) == lines, fmt
+            filename = os.path.join(tmpdir, "timespans." + fmt)
+            assert export_timespans(timespans_by_label, filename) == sum(map(len, timespans_by_label.values()))
+            assert load_timespans(filename) == {label: entries for label, entries in timespans_by_label.items()
+                                                if entries}, fmt
+        # Row formats are written in chunks, so memory use should not grow with the number of records:
+        records = itertools.chain.from_iterable(itertools.repeat(list(iter_event_records(lines[:1000])), 200))
+        tracemalloc.start()
+        try:
+            nrecords = write_records(records, os.path.join(tmpdir, "many.jsonl"), event_fields, chunksize=1000)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert nrecords == 200000 and peak < 5e6, (nrecords, peak)
+    print("Exported events and timespans are loaded unchanged (formats: %s)." % ", ".join(formats))
+
+
+def test_query_cache(nevents=50000, seed=0):
+    """
+    Check that QueryCache gives the same results as filter_main, is invalidated when the data changes,
+    and that filter_main does not modify its input.
+    """
+    import copy
+    import random
+    import tempfile
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filenames = generate_timetracker_files(tmpdir, nevents, nlabels=20, seed=seed)
+        timespans_by_label = find_timespans_by_label(get_lines_by_label(parse_files(filenames)),
+                                                     now=datetime(2040, 1, 1))
+    labels = sorted(timespans_by_label)
+    queries = [{"labels": rng.sample(labels, 3) if rng.random() < 0.3 else None,
+                "exclude_labels": [label.lower() for label in rng.sample(labels, 2)] if rng.random() < 0.3 else None,
+                "tags": ["#tag%s" % rng.randint(0, 4)] if rng.random() < 0.3 else None,
+                "window_start": datetime(2015, 7, 1) + timedelta(days=rng.randint(0, 30)) if rng.random() < 0.5
+                                else None,
+                "discart_empty_labels": rng.random() < 0.5} for _ in range(20)]
+    original = copy.deepcopy(timespans_by_label)
+    cache, versioned_cache = QueryCache(maxsize=10), QueryCache(maxsize=10)
+    timings = {"filter_main": 0, "QueryCache": 0, "QueryCache(version)": 0}
+    for _ in range(5):
+        for args in queries:
+            args_copy = copy.deepcopy(args)
+            start = time.perf_counter()
+            expected = filter_main(timespans_by_label, args)
+            timings["filter_main"] += time.perf_counter() - start
+            start = time.perf_counter()
+            assert cache.query(timespans_by_label, args) == expected, args
+            timings["QueryCache"] += time.perf_counter() - start
+            start = time.perf_counter()
+            assert versioned_cache.query(timespans_by_label, args, version=0) == expected, args
+            timings["QueryCache(version)"] += time.perf_counter() - start
+            assert args == args_copy
+    assert timespans_by_label == original
+    assert len(cache.results) <= 10 and cache.hits > 0
+    # Equivalent arguments give the same cache key:
+    assert normalize_filter_args({"labels": ["a", "B"], "tags": "#x #y"}) == \
+        normalize_filter_args({"labels": ["b", "A"], "tags": ["y", "x"], "match_all_tags": False})
+    # Adding a timespan changes the fingerprint and invalidates the cache:
+    label = labels[0]
+    last = timespans_by_label[label][-1]
+    timespans_by_label[label].append(dict(last, start=last["stop"], stop=last["stop"] + timedelta(hours=1)))
+    for args in queries:
+        assert cache.query(timespans_by_label, args) == filter_main(timespans_by_label, args), args
+    # Correcting the stop time of a timespan in the middle (not the first or last) invalidates the cache:
+    entries = timespans_by_label[label]
+    args = {"end_after": entries[len(entries) // 2]["stop"] + timedelta(minutes=1)}
+    assert cache.query(timespans_by_label, args) == filter_main(timespans_by_label, args)
+    timespans_by_label = dict(timespans_by_label, **{label: list(entries)})
+    middle = timespans_by_label[label][len(entries) // 2]
+    timespans_by_label[label][len(entries) // 2] = dict(middle, stop=middle["stop"] + timedelta(minutes=10),
+                                                        timespan=middle["timespan"] + timedelta(minutes=10))
+    assert cache.query(timespans_by_label, args) == filter_main(timespans_by_label, args)
+    # An explicit version is used instead of the fingerprint:
+    assert cache.query(timespans_by_label, args, version=1) == filter_main(timespans_by_label, args)
+    assert cache.query({}, args, version=1) is cache.query(timespans_by_label, args, version=1)
+    assert cache.query({}, args, version=2) == filter_main({}, args)
+    print("QueryCache gives the same results as filter_main (%s hits, %s misses; %.3f s with fingerprints, "
+          "%.3f s with version vs %.3f s uncached)." % (cache.hits, cache.misses, timings["QueryCache"],
+                                                        timings["QueryCache(version)"], timings["filter_main"]))
+
+
+def benchmark_plot_timeline(nspans=100000, seed=0):
+    """ Time saving a time-line plot of nspans random timespans to a png file, with and without decimation. """
+    import random
+    import tempfile
+    rng = random.Random(seed)
+    timespans_by_label = defaultdict(list)
+    start = datetime(2015, 6, 1, 8, 0)
+    for _ in range(nspans):
+        label = "Activity %s" % rng.randint(1, 20)
+        start += timedelta(minutes=rng.randint(0, 30))
+        stop = start + timedelta(minutes=rng.randint(1, 60))
+        timespans_by_label[label].append({"label": label, "start": start, "stop": stop, "timespan": stop-start})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for decimate in (True, False):
+            start = time.perf_counter()
+            plot_timeline(timespans_by_label, output=os.path.join(tmpdir, "timeline.png"), decimate=decimate)
+            print("plot_timeline(decimate=%s): %s timespans in %.2f s" % (decimate, nspans, time.perf_counter()-start))
+
+
+def benchmark_startup(nruns=5):
+    """
+    Measure the import time of this module (using python -X importtime) and the end-to-end time
+    of running the command line interface on a small file (best of nruns).
+    """
+    import subprocess
+    import tempfile
+    modulename = os.path.splitext(os.path.basename(__file__))[0]
+    moduledir = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + modulename], cwd=moduledir,
+                          stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    # Lines are: "import time: self [us] | cumulative | imported package", sorted by completion:
+    imports = [[field.strip() for field in line.split(":", 1)[1].split("|")] for line in proc.stderr.splitlines()
+               if line.startswith("import time:") and "cumulative" not in line]
+    print("Import time for %s: %.1f ms. Slowest top-level imports:" % (modulename, int(imports[-1][1])/1000))
+    toplevel = [(int(cumulative), name) for _, cumulative, name in imports[:-1] if not name.startswith(" ")]
+    for cumulative, name in sorted(toplevel, reverse=True)[:5]:
+        print("    %-20s %6.1f ms" % (name, cumulative/1000))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename, = generate_timetracker_files(tmpdir, 100)
+        cmd = [sys.executable, os.path.abspath(__file__), "--no-timelineplot", "--report", "label",
+               "--cache-dir", os.path.join(tmpdir, "cache"), filename]
+        timings = []
+        for _ in range(nruns):
+            start = time.perf_counter()
+            subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            timings.append(time.perf_counter() - start)
+    print("End-to-end time for a report on a 100-line file: %.1f ms (best of %s runs)." % (min(timings)*1000, nruns))
+
+
+def benchmark_columns_memory(nlines=200000):
+    """ Compare the memory used by line dicts and timespans_by_label with EventColumns and TimespanColumns. """
+    import tempfile
+    import tracemalloc
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename, = generate_timetracker_files(tmpdir, nlines)
+        tracemalloc.start()
+        for description, func in (
+                ("line dicts", lambda: parse_file_bulk(filename)),
+                ("EventColumns", lambda: lines_to_columns(parse_file_bulk(filename))),
+                ("timespans_by_label", lambda: find_timespans_by_label(get_lines_by_label(parse_file(filename)))),
+                ("TimespanColumns",
+                 lambda: timespans_to_columns(find_timespans_by_label(get_lines_by_label(parse_file(filename)))))):
+            before = tracemalloc.get_traced_memory()[0]
+            result = func()
+            used = tracemalloc.get_traced_memory()[0] - before
+            nitems = len(result) if not isinstance(result, dict) else sum(len(v) for v in result.values())
+            print("%20s: %8.1f MB, %6.1f bytes per item" % (description, used/1e6, used/nitems))
+            del result
+        tracemalloc.stop()
+
+
+def benchmark_parse_files(nlines=1000000, nfiles=4, workers=4):
+    """
+    Compare parse_files with and without bulk=True on a file with nlines random lines, and with the cache.
+    Then time parse_files(bulk=True) on nlines lines in nfiles files serially (and sorting the lines) and with
+    workers processes (which returns the lines sorted). Note: The number of workers used is limited to the number
+    of CPUs, so there is no speedup with one CPU.
+    """
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename, = generate_timetracker_files(tmpdir, nlines)
+        size = os.path.getsize(filename)
+        for bulk in (False, True):
+            start = time.perf_counter()
+            parse_files([filename], bulk=bulk)
+            duration = time.perf_counter() - start
+            print("parse_files(bulk=%s): %s lines in %.2f s (%.1f MB/s)" % (bulk, nlines, duration, size/duration/1e6))
+        cache_dir = os.path.join(tmpdir, "cache")
+        for description in ("creating cache", "cached", "cached, after appending a line"):
+            if description.endswith("appending a line"):
+                with open(filename, "a") as filep:
+                    filep.write("2030-01-01 08.00 start appended line\n")
+            start = time.perf_counter()
+            parse_files([filename], cache_dir=cache_dir)
+            print("parse_files(cache_dir=...), %s: %.2f s" % (description, time.perf_counter() - start))
+        dirname = os.path.join(tmpdir, "files")
+        os.mkdir(dirname)
+        filenames = generate_timetracker_files(dirname, nlines, nfiles=nfiles)
+        for nworkers in (None, workers):
+            start = time.perf_counter()
+            lines = parse_files(filenames, bulk=True, workers=nworkers)
+            if nworkers is None:
+                lines.sort(key=line_sort_key)
+            print("parse_files(bulk=True, workers=%s)%s: %s files in %.2f s (%s CPUs)" % (
+                nworkers, " and sort" if nworkers is None else "", nfiles, time.perf_counter() - start,
+                os.cpu_count()))
+            lines = None
+
+
+def benchmark_parallel_parse(nfiles=8, nlines=100000, workers=(2, 4, 8)):
+    """
+    Compare parse_files(bulk=True) serially (including sorting the lines) and with each number of workers
+    on nfiles files with nlines random lines each, and show how much smaller the worker results are as
+    EventColumns than as line dicts.
+    Note: The number of workers used is limited to the number of CPUs, so there is no speedup with one CPU.
+    """
+    import gc
+    import pickle
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filenames = generate_timetracker_files(tmpdir, nfiles*nlines, nfiles=nfiles)
+        lines = _parse_file_sorted(filenames[0], bulk=True)
+        for description, payload in (("line dicts", lines), ("EventColumns", lines_to_columns(lines))):
+            start = time.perf_counter()
+            pickle.loads(pickle.dumps(payload))
+            print("Worker result for one file as %s: %.1f MB, pickle round-trip %.2f s" % (
+                description, len(pickle.dumps(payload))/1e6, time.perf_counter() - start))
+        # With workers, the lines are returned sorted, so the serial timing includes the sort done
+        # by get_lines_by_label (which is skipped with presorted=True):
+        start = time.perf_counter()
+        expected = parse_files(filenames, bulk=True)
+        expected.sort(key=line_sort_key)
+        serial = time.perf_counter() - start
+        print("parse_files(bulk=True) and sort, serial: %s lines in %.2f s" % (len(expected), serial))
+        for nworkers in workers:
+            lines = None
+            gc.collect()
+            start = time.perf_counter()
+            lines = parse_files(filenames, bulk=True, workers=nworkers)
+            duration = time.perf_counter() - start
+            assert lines == expected
+            print("parse_files(bulk=True, workers=%s): %.2f s (%.2fx speedup, %s CPUs)" % (
+                nworkers, duration, serial/duration, os.cpu_count()))
+
+
+benchmark_results_file = "timetracker_benchmarks.jsonl"
+
+
+def benchmark_suite(sizes=(10**3, 10**4, 10**5, 10**6), results_file=benchmark_results_file, nfiles=4,
+                    repeat=3, threshold=1.2, seed=0):
+    """
+    Benchmark the pipeline stages (parse_files, get_lines_by_label, find_timespans_by_label, filter_main
+    and report_totals/format_report) on generated files with each number of events in sizes.
+    Each stage is run repeat times (once for sizes above 10**5) and the best time is recorded.
+
+    Results are appended to results_file (one json record per line with stage, events, seconds, etc.)
+    and compared to the best previous result for the same stage and number of events, printing
+    "REGRESSION" if the stage is more than threshold times slower.
+    Note: 10**7 events require several GB of memory (each line is a dict).
+    """
+    import tempfile
+    import platform
+    previous = defaultdict(list)
+    if results_file and os.path.exists(results_file):
+        with open(results_file) as filep:
+            for line in filep:
+                record = json.loads(line)
+                previous[(record["stage"], record["events"])].append(record["seconds"])
+    run_info = {"run": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version()}
+    records = []
+    # Malformed lines in the generated files would otherwise give a lot of warnings:
+    logging.disable(logging.WARNING)
+    print("%-22s %10s %9s %12s %9s" % ("Stage", "Events", "Seconds", "Events/s", "Previous"))
+    for nevents in sizes:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filenames = generate_timetracker_files(tmpdir, nevents, nfiles=nfiles, seed=seed)
+            args = process_args(None, filenames + ["--no-cache", "--window-start", "2015-07-01", "00:00",
+                                                   "--exclude-labels", "activity 1"])
+            state = {}
+            # (stage, setup, func): setup() returns the input to func, and is not included in the timing.
+            # get_lines_by_label modifies its input, so it is given a copy:
+            stages = [
+                ("parse_files", None, lambda _: state.update(lines=parse_files(filenames))),
+                ("parse_files(bulk)", None, lambda _: parse_files(filenames, bulk=True)),
+                ("parse_files(bulk,-j4)", None, lambda _: parse_files(filenames, bulk=True, workers=4)),
+                ("get_lines_by_label", lambda: [dict(line) for line in state["lines"]],
+                 lambda lines: state.update(lines_by_label=get_lines_by_label(lines))),
+                ("find_timespans", None, lambda _: state.update(
+                    timespans=find_timespans_by_label(state["lines_by_label"], now=datetime(2040, 1, 1)))),
+                ("filter_main", None, lambda _: filter_main(state["timespans"], args)),
+                ("report(label)", None, lambda _: format_report(report_totals(state["timespans"], "label"))),
+                ("report(day)", None, lambda _: format_report(report_totals(state["timespans"], "day"))),
+            ]
+            for stage, setup, func in stages:
+                timings = []
+                for _ in range(repeat if nevents <= 10**5 else 1):
+                    data = setup() if setup else None
+                    start = time.perf_counter()
+                    func(data)
+                    timings.append(time.perf_counter() - start)
+                    del data
+                seconds = min(timings)
+                record = dict(run_info, stage=stage, events=nevents, seconds=seconds)
+                records.append(record)
+                best = min(previous[(stage, nevents)], default=None)
+                comparison = "-" if best is None else "%.2fx" % (seconds/best) if best else "-"
+                print("%-22s %10s %9.3f %12.0f %9s%s" % (
+                    stage, nevents, seconds, nevents/seconds if seconds else float("inf"), comparison,
+                    "  REGRESSION" if best and seconds > threshold*best else ""))
+            state.clear()
+    logging.disable(logging.NOTSET)
+    if results_file:
+        with open(results_file, "a") as filep:
+            for record in records:
+                filep.write(json.dumps(record) + "\n")
+        print("Results appended to", results_file)
+    return records
+
+
+def benchmark_suite_main(argv=None):
+    """ Command line interface for benchmark_suite (--benchmark-suite). """
+    parser = argparse.ArgumentParser(description="Benchmark the time tracker pipeline on generated files.")
+    parser.add_argument("--benchmark-suite", action="store_true")
+    parser.add_argument("--max-events", type=int, default=10**6,
+                        help="Benchmark with 10**3, 10**4, ... events up to this number (default: 10**6).")
+    parser.add_argument("--results-file", default=benchmark_results_file,
+                        help="Append results to this file and compare with previous results in it.")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="Report a regression if a stage is this many times slower than previously.")
+    args = parser.parse_args(argv)
+    sizes = [10**exponent for exponent in range(3, 8) if 10**exponent <= args.max_events]
+    benchmark_suite(sizes, results_file=args.results_file, threshold=args.threshold)
+
+
+def test_generator():
+    """ Check that generate_timetracker_files is deterministic and produces the requested data. """
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dirs = [os.path.join(tmpdir, name) for name in ("a", "b")]
+        for dirname in dirs:
+            os.mkdir(dirname)
+        filenames = [generate_timetracker_files(dirname, 20000, nfiles=3, nlabels=20, malformed_rate=0.05)
+                     for dirname in dirs]
+        assert len(filenames[0]) == 3
+        for fn_a, fn_b in zip(*filenames):
+            with open(fn_a) as file_a, open(fn_b) as file_b:
+                assert file_a.read() == file_b.read()
+        nlines = sum(count_file_lines(filename)[1] for filename in filenames[0])
+        assert nlines == 20000, nlines
+        lines = parse_files(filenames[0])
+        unmatched = nlines - len(lines)
+        assert 0.03 < unmatched/nlines < 0.07, unmatched
+        assert len({line["label"] for line in lines}) == 20
+        assert any(line["tags"] for line in lines) and any(line["comment"] for line in lines)
+        timespans_by_label = find_timespans_by_label(get_lines_by_label(lines), now=datetime(2040, 1, 1))
+        assert sum(len(entries) for entries in timespans_by_label.values()) > 0.4*nlines
+    print("test_generator: OK")
+
+
+def test_time_tracker(nevents=20000, nbatches=50, nshuffled=3000, seed=0):
+    """
+    Check that TimeTracker gives the same timespans as get_lines_by_label and find_timespans_by_label
+    when lines are added in batches, one at a time and out of order, that in order appends take constant
+    time, and that tail_file, watch_files and the query server work.
+    """
+    import random
+    import tempfile
+    import threading
+    from urllib.request import urlopen
+    rng = random.Random(seed)
+    now = datetime(2040, 1, 1)
+    def as_tuples(timespans_by_label):
+        """ Return comparable {label: [(start, stop, timespan)]} (including labels without timespans). """
+        return {label: [(entry["start"], entry["stop"], entry["timespan"]) for entry in entries]
+                for label, entries in timespans_by_label.items()}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filenames = generate_timetracker_files(tmpdir, nevents, nfiles=3, seed=seed)
+        lines = parse_files(filenames)
+        # Add events with other actions than start/stop, which stop auto_stop_on_start for their label:
+        lines += [{"datetime": line["datetime"] + timedelta(minutes=rng.randint(0, 30)), "action": "pause",
+                   "label": line["label"], "tags": "", "comment": None, "filename": "pauses.txt", "lineno": lineno}
+                  for lineno, line in enumerate(rng.sample(lines, len(lines) // 20))]
+        for auto_stop_on_start in (True, False):
+            expected = find_timespans_by_label(get_lines_by_label(
+                [dict(line) for line in lines], auto_stop_on_start=auto_stop_on_start), now=now)
+            # Lines from each file in order (as when watching files), but files interleaved in time:
+            state = TimeTracker(auto_stop_on_start=auto_stop_on_start)
+            cuts = sorted(rng.sample(range(1, len(lines)), nbatches - 1))
+            for start, stop in zip([0] + cuts, cuts + [len(lines)]):
+                state.add_lines(lines[start:stop])
+            assert as_tuples(state.timespans_by_label(now)) == as_tuples(expected)
+            assert state.nevents == len(lines) and len(state) == sum(map(len, expected.values()))
+            # In time order, then a part of the lines one at a time in random order:
+            ordered = sorted(lines, key=line_sort_key)
+            shuffled = rng.sample(ordered, nshuffled)
+            ids = set(map(id, shuffled))
+            state = TimeTracker(auto_stop_on_start=auto_stop_on_start)
+            for line in ordered:
+                if id(line) not in ids:
+                    state.add_line(line)
+            for line in shuffled:
+                state.add_line(line)
+            assert as_tuples(state.timespans_by_label(now)) == as_tuples(expected)
+            running = {label for label, entries in expected.items() if entries and entries[-1]["stop"] == now}
+            assert state.running_labels() == sorted(running)
+            window = {"window_start": datetime(2015, 9, 1), "window_end": datetime(2015, 9, 8)}
+            filtered = filter_timespans(expected, window)
+            assert as_tuples(state.timespans_by_label(now, **window)) == as_tuples(filtered)
+            totals = {row["group"]: (row["minutes"], row["count"]) for row in state.totals(now, **window)}
+            assert totals == {label: (sum(int(entry["timespan"].total_seconds() // 60) for entry in entries),
+                                      len(entries)) for label, entries in filtered.items() if entries}
+            totals = {row["group"]: (row["minutes"], row["count"]) for row in state.totals(now)}
+            assert totals == {label: (sum(int(entry["timespan"].total_seconds() // 60) for entry in entries),
+                                      len(entries)) for label, entries in expected.items() if entries}
+
+        # Append to a file in chunks (also partial lines) while watching it:
+        filename = os.path.join(tmpdir, "watched.txt")
+        with open(filenames[0], "rb") as filep:
+            data = filep.read()
+        state, lock, positions = TimeTracker(), threading.Lock(), {}
+        open(filename, "wb").close()
+        for start in range(0, len(data), 10000):
+            with open(filename, "ab") as filep:
+                filep.write(data[start:start+10000])
+            watch_files([filename], state, lock, max_polls=1, positions=positions)
+        expected = find_timespans_by_label(get_lines_by_label(parse_file_bulk(filename)), now=now)
+        assert as_tuples(state.timespans_by_label(now)) == as_tuples(expected)
+
+        server = start_query_server(state, lock, port=0)
+        try:
+            url = "http://%s:%s" % server.server_address[:2]
+            with urlopen(url + "/status") as response:
+                status = json.loads(response.read().decode())
+            assert status["events"] == state.nevents and status["timespans"] == len(state)
+            with urlopen(url + "/totals?window_start=2015-06-01T00:00&window_end=2015-07-01T00:00") as response:
+                rows = json.loads(response.read().decode())["totals"]
+            assert rows == state.totals(window_start=datetime(2015, 6, 1), window_end=datetime(2015, 7, 1))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    # Short random event sequences with several labels and pauses, added in random order:
+    for trial in range(500):
+        events = [{"datetime": datetime(2020, 1, 1, 8, rng.randint(0, 59)), "filename": "events", "lineno": lineno,
+                   "action": rng.choice(("start", "start", "stop", "pause")), "label": rng.choice("ABC")}
+                  for lineno in range(rng.randint(1, 15))]
+        for auto_stop_on_start in (True, False):
+            expected = find_timespans_by_label(get_lines_by_label(
+                [dict(event) for event in events], auto_stop_on_start=auto_stop_on_start), now=now)
+            state = TimeTracker(auto_stop_on_start=auto_stop_on_start)
+            for event in rng.sample(events, len(events)):
+                state.add_line(event)
+            assert as_tuples(state.timespans_by_label(now)) == as_tuples(expected), (trial, events)
+
+    # A label with only stop events has no timespans, and is not included (as in find_timespans_by_label):
+    events = [{"datetime": datetime(2020, 1, 1, 8, minute), "action": action, "label": label,
+               "filename": "events", "lineno": minute}
+              for minute, action, label in ((0, "start", "Foo"), (10, "stop", "Ghost"), (20, "stop", "Foo"))]
+    expected = find_timespans_by_label(get_lines_by_label([dict(event) for event in events]), now=now)
+    for auto_stop_on_start in (True, False):
+        state = TimeTracker(auto_stop_on_start=auto_stop_on_start)
+        state.add_lines(events)
+        assert as_tuples(state.timespans_by_label(now)) == as_tuples(expected) and list(expected) == ["Foo"]
+
+    # Events from e.g. a message queue (without filename and lineno), appended in order:
+    state = TimeTracker()
+    times = []
+    for n in (10**4, 10**5):
+        events = [{"datetime": datetime(2020, 1, 1) + timedelta(minutes=i), "action": ("start", "stop")[i % 2],
+                   "label": "label%s" % (i % 10 // 2)} for i in range(n)]
+        state.clear()
+        t0 = time.perf_counter()
+        for event in events:
+            state.add_line(event)
+        times.append((time.perf_counter() - t0) / n)
+    assert len(state) == 10**5 // 2 and not state.running
+    print("Append time per event: %.2f us (10^4 events), %.2f us (10^5 events)" % (times[0]*1e6, times[1]*1e6))
+    print("test_time_tracker: OK")
+
 
 if __name__ == '__main__':
-    if "--test2" in sys.argv:
+    if "--benchmark-suite" in sys.argv:
+        benchmark_suite_main()
+    elif "--test-time-tracker" in sys.argv:
+        test_time_tracker()
+    elif "--test-generator" in sys.argv:
+        test_generator()
+    elif "--benchmark-parallel-parse" in sys.argv:
+        benchmark_parallel_parse()
+    elif "--benchmark-parse" in sys.argv:
+        benchmark_parse_files()
+    elif "--benchmark-startup" in sys.argv:
+        benchmark_startup()
+    elif "--benchmark-plot" in sys.argv:
+        benchmark_plot_timeline()
+    elif "--test-tag-index" in sys.argv:
+        test_tag_index()
+    elif "--test-sweep" in sys.argv:
+        test_sweep_timespans()
+    elif "--test-export" in sys.argv:
+        test_export()
+    elif "--test-query-cache" in sys.argv:
+        test_query_cache()
+    elif "--test-report" in sys.argv:
+        test_report()
+    elif "--test-interval-index" in sys.argv:
+        test_interval_index()
+    elif "--benchmark-columns-memory" in sys.argv:
+        benchmark_columns_memory()
+    elif "--test-parse-cache" in sys.argv:
+        test_parse_cache()
+    elif "--test-parallel-parse" in sys.argv:
+        test_parallel_parse()
+    elif "--test-bulk-parse" in sys.argv:
+        test_bulk_parse()
+    elif "--test-parse-timestamp" in sys.argv:
+        test_parse_timestamp()
+    elif "--benchmark-timestamps" in sys.argv:
+        benchmark_timestamp_parsing()
+    elif "--benchmark-lines-by-label" in sys.argv:
+        benchmark_lines_by_label()
+    elif "--test-timespans" in sys.argv:
+        test_timespans_regression()
+    elif "--test2" in sys.argv:
         test2()
     elif "--test" in sys.argv:
         test1()